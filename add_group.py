@@ -1,10 +1,9 @@
-import dill as pkl
 import pandas as pd
 import os
 
 import argparse
 
-from utils import capture
+from utils import read_manifest
 from load_data import load_groups, save_groups, get_projects_and_owners
 
 from add_users import get_name, get_nuid, get_email
@@ -30,40 +29,87 @@ def proceed():
             print("Please enter either y or n.")
 
 
-def add_group(pkl_path, gid, dept):
+# Adds several (gid, department) pairs with one load, one project scan and one concat, sort and save
+def add_groups(pkl_path, entries, project_owners=None):
     groups = load_groups(pkl_path)
 
-    if dept not in list(groups["dept"]):
-        print(f"The provided department {dept} does not already exist. Still add group?")
+    new_departments = sorted({dept for _, dept in entries} - set(groups["dept"]))
+    if new_departments:
+        print(f"The provided department(s) {', '.join(new_departments)} do not already exist. Still add group(s)?")
         if not proceed():
             print("Exiting.")
             return
 
-    # Check if group already exists before proceeding
-    if (groups["gid"] == gid).any():
-        print(f"User {gid} already exists; skipping.")
-    else:
-        ngid = capture(f'id -u {gid}').strip()
+    known_gids = set(groups["gid"])
+    new_groups = []
+    for gid, dept in entries:
+        # Check if group already exists before proceeding
+        if gid in known_gids:
+            print(f"User {gid} already exists; skipping.")
+            continue
+        known_gids.add(gid)
+
+        if project_owners is None:
+            _, project_owners = get_projects_and_owners(cache_dir=pkl_path)
+
+        ngid = get_nuid(gid)
         name = get_name(gid)
         first_name = name["first_name"]
         last_name = name["last_name"]
+        if first_name == "":
+            raise RuntimeError(f"User {gid} has no name in the passwd database. No groups were added.")
         email = get_email(gid)
-        _, project_owners = get_projects_and_owners()
         projects = ', '.join(project_owners[gid])
 
-        groups = pd.concat([groups, pd.DataFrame([[gid, projects, first_name, last_name, email, dept, ngid]], columns=groups.columns)], ignore_index=True)
+        new_groups.append([gid, projects, first_name, last_name, email, dept, ngid])
+
+    if new_groups:
+        groups = pd.concat([groups, pd.DataFrame(new_groups, columns=groups.columns)], ignore_index=True)
         groups = groups.sort_values("gid")
 
         save_groups(pkl_path, groups)
 
 
-def parse_arguments():
-    parser = argparse.ArgumentParser()
+def add_group(pkl_path, gid, dept):
+    add_groups(pkl_path, [(gid, dept)])
+
+
+# Reads (gid, department) rows from a manifest and checks all of them against one project scan
+# and the passwd database before anything is saved
+def add_groups_from_manifest(pkl_path, manifest):
+    entries = []
+    errors = []
+    for row in read_manifest(manifest, header="gid"):
+        if len(row) != 2:
+            errors.append(f"Expected gid and department, got {', '.join(row)}.")
+            continue
+        entries.append((row[0], row[1]))
+
+    _, project_owners = get_projects_and_owners(cache_dir=pkl_path)
+    for gid, _ in entries:
+        if not user_exists(gid):
+            errors.append(f"User {gid} does not exist.")
+        elif gid not in project_owners:
+            errors.append(f"User {gid} does not own any projects.")
+        elif get_name(gid)["first_name"] == "":
+            errors.append(f"User {gid} has no name in the passwd database.")
+
+    if errors:
+        print("\n".join(errors))
+        print("No groups were added.")
+        return
 
-    parser.add_argument("gid")
-    parser.add_argument("department")
-    args = parser.parse_args()
+    print("You entered ")
+    for gid, dept in entries:
+        print(f"gid: {gid}, department: {dept}")
 
+    if proceed():
+        add_groups(pkl_path, entries, project_owners=project_owners)
+    else:
+        print("Exiting.")
+
+
+def parse_arguments(args):
     gid = args.gid
     dept = args.department
 
@@ -83,5 +129,17 @@ def parse_arguments():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("gid", nargs="?")
+    parser.add_argument("department", nargs="?")
+    parser.add_argument("-m", "--manifest", help="CSV or TSV file of gid,department rows to add at once")
+    args = parser.parse_args()
+
     path_to_pkl = os.getenv("REPORT_DATA_PATH", os.getcwd())
-    add_group(path_to_pkl, *parse_arguments())
+    if args.manifest is not None:
+        add_groups_from_manifest(path_to_pkl, args.manifest)
+    elif args.gid is None or args.department is None:
+        parser.error("provide a gid and department, or --manifest")
+    else:
+        add_group(path_to_pkl, *parse_arguments(args))
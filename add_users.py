@@ -1,29 +1,53 @@
-import dill as pkl
 import pandas as pd
 import os
+import pwd
 import argparse
+from functools import lru_cache
 
-from utils import capture
+from utils import run_command
 
 from load_data import Context
 
 
+# passwd entries are looked up in-process and cached for the run, instead of running getent/id per user
+@lru_cache(maxsize=None)
+def get_passwd(uid: str):
+    try:
+        return pwd.getpwnam(uid)
+    except KeyError:
+        return None
+
+
 def user_exists(uid: str):
-    s = capture(f"getent passwd {uid}").strip()
-    return s != ""
+    return get_passwd(uid) is not None
 
 
 def get_name(uid: str):
-    s = capture(f"getent passwd {uid}").strip()
-    name = s.split(":")[4]
-    first_name = name.split()[0]
-    last_name = name.split()[-1]
+    name = get_passwd(uid).pw_gecos.split()
+    first_name = name[0] if name else ""
+    last_name = name[-1] if name else ""
 
     return {"first_name": first_name, "last_name": last_name}
 
 
 def get_nuid(uid: str):
-    return capture(f"id -u {uid}").strip()
+    return str(get_passwd(uid).pw_uid)
+
+
+# Maps every user in slurmdb to its accounts with a single sacctmgr call
+def get_user_accounts():
+    user_accounts = {}
+    for line in run_command(["sacctmgr", "list", "assoc", "format=User,Account", "-Pn"]).lines():
+        if "|" not in line:
+            continue
+        user, account = line.split("|")[:2]
+        if user == "":
+            continue
+        user_accounts.setdefault(user, [])
+        if account not in user_accounts[user]:
+            user_accounts[user].append(account)
+
+    return user_accounts
 
 
 def get_email(uid: str):
@@ -40,13 +64,13 @@ def get_project_owner(context: Context, project: str):
 def update_users(context: Context):
     unknown_ngids = set()
 
-    sacctmgr_output = capture("sacctmgr list user -Pn").strip().split("\n")
+    sacctmgr_output = [line for line in run_command(["sacctmgr", "list", "user", "-Pn"]).lines() if line.strip()]
+    user_accounts = get_user_accounts()
     andromeda_users = []
     for line in sacctmgr_output:
         uid, project, _, _ = line.split("|")
-        projects = capture(f"sacctmgr show user {uid} withassoc format=Account%30 -n | awk '{{$1=$1}};1'").strip().split("\n")
-        projects = ', '.join(projects)
-        if uid not in context.uids:
+        projects = ', '.join(user_accounts.get(uid, []))
+        if uid not in context.uid_to_gid:
             if user_exists(uid):
                 new_user = {"uid": uid, "nuid": get_nuid(uid), 
                             "projects": projects, "gid": get_project_owner(context, project), 
@@ -56,31 +80,25 @@ def update_users(context: Context):
                 if context.verbose:
                     print(f"User {uid} exists in slurmdb but not posix permissions.")
 
-    # Updating userInfo
-    def add_user(users, user_info, context):
+    # Updating userInfo; new users are collected first and merged with a single concat and sort
+    users = context.users
+    known_uids = set(users["uid"])
+    new_users = []
+    for user_info in andromeda_users:
         uid = user_info["uid"]
 
         # Check if user already exists before proceeding
-        if uid in list(users["uid"]):
-            return
-        else:
-            if context.verbose:
-                print(f"Adding {uid}")
-
-        nuid = user_info["nuid"]
-        projects = user_info["projects"]
-        gid = user_info["gid"]
-        first_name = user_info["first_name"]
-        last_name = user_info["last_name"]
-        email = user_info["email"]
-
-        users = pd.concat([users, pd.DataFrame([[uid, nuid, projects, gid, first_name, last_name, email]], columns=users.columns)], ignore_index=True)
-        return users.sort_values("uid")
+        if uid in known_uids:
+            continue
+        known_uids.add(uid)
+        if context.verbose:
+            print(f"Adding {uid}")
 
-    users = context.users
-    for user_info in andromeda_users:
-        users = add_user(users, user_info, context)
-    context.save_users(users)
+        new_users.append([uid, user_info["nuid"], user_info["projects"], user_info["gid"], user_info["first_name"], user_info["last_name"], user_info["email"]])
+
+    if new_users:
+        users = pd.concat([users, pd.DataFrame(new_users, columns=users.columns)], ignore_index=True)
+        context.save_users(users.sort_values("uid"))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
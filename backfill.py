@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from dateutil import relativedelta
+
+from utils import parse_date, set_verbosity
+from load_data import Context
+from report_generator import SREPORTGenerator
+
+
+# -- Fetches sreport usage for every (gid, month) of a long date range, one unit at a time ---------------- #
+# -- Each completed unit is committed to the usage store (through the journal) immediately, so the -------- #
+# -- command can be interrupted and run again to process only the units that are still missing. ----------- #
+
+class BackfillQueue:
+    def __init__(self, pkl_path):
+        self.path = os.path.join(pkl_path, "backfill_queue.json")
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, first_month, num_months):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"first_month": str(first_month), "num_months": num_months}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if self.exists():
+            os.remove(self.path)
+
+
+def fetch_with_retries(generator, gid, max_retries, backoff):
+    for attempt in range(max_retries + 1):
+        try:
+            return generator.get_user_usage_sreport(gid)
+        except Exception as e:
+            if attempt == max_retries:
+                raise
+            delay = backoff * 2**attempt
+            print(f"Fetching {gid} for {generator.start_date} failed ({e}); retrying in {delay:.0f} seconds.")
+            time.sleep(delay)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def backfill(context, months, max_workers=4, max_retries=3, backoff=5.0):
+    generators = [SREPORTGenerator(context, month) for month in months]
+    units = [(generator, gid) for generator in generators for gid in context.gids if not generator.month_has_data(gid)]
+
+    total = len(generators)*len(context.gids)
+    done = total - len(units)
+    print(f"{done}/{total} units already stored; {len(units)} remaining.")
+
+    failed = []
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(fetch_with_retries, generator, gid, max_retries, backoff): (generator, gid) for generator, gid in units}
+        for n, future in enumerate(as_completed(futures), 1):
+            generator, gid = futures[future]
+            try:
+                context.usage.set(gid, generator.start_date, future.result())
+            except Exception as e:
+                failed.append((gid, generator.start_date))
+                print(f"Giving up on {gid} for {generator.start_date}: {e}")
+                continue
+
+            elapsed = time.time() - t0
+            eta = elapsed/n*(len(units) - n)
+            print(f"[{done + n}/{total}] {gid} {generator.start_date}  elapsed {format_duration(elapsed)}  ETA {format_duration(eta)}")
+
+    context.flush_usage()
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("date", nargs="?")
+    parser.add_argument("--num-months", type=int, default=13)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-retries", type=int, default=3)
+    parser.add_argument("--backoff", type=float, default=5.0)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    set_verbosity(args.verbose)
+    path_to_pkl = os.getenv("REPORT_DATA_PATH", os.getcwd())
+    queue = BackfillQueue(path_to_pkl)
+
+    # Without a date, resume the range of the last interrupted backfill
+    if args.date is None:
+        if not queue.exists():
+            print("No backfill to resume; provide a date.")
+            quit()
+        saved = queue.load()
+        first_month, num_months = parse_date(saved["first_month"]), saved["num_months"]
+    else:
+        this_month = parse_date(args.date)
+        first_month, num_months = this_month - relativedelta.relativedelta(months=args.num_months), args.num_months
+        queue.save(first_month, num_months)
+
+    months = [first_month + relativedelta.relativedelta(months=i) for i in range(num_months)]
+    print(f"Backfilling {months[0]} through {months[-1]}.")
+
+    context = Context(verbosity=args.verbose, insert_data=True, path_to_pkl=path_to_pkl)
+    failed = backfill(context, months, max_workers=args.workers, max_retries=args.max_retries, backoff=args.backoff)
+
+    if failed:
+        print(f"{len(failed)} units failed. Run `python backfill.py` again to retry them.")
+    else:
+        queue.clear()
+        print("Backfill complete.")
@@ -0,0 +1,70 @@
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from utils import parse_time, parse_mem, parse_time_column, parse_mem_column, parse_ncpus_column
+
+
+# -- Compares the scalar sacct parsers in utils with their column-wise versions on synthetic sacct columns -- #
+
+def make_columns(num_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    days = rng.integers(0, 14, num_rows)
+    hrs, mins, secs = rng.integers(0, 24, num_rows), rng.integers(0, 60, num_rows), rng.integers(0, 60, num_rows)
+    elapsed = [f"{d}-{h:02d}:{m:02d}:{s:02d}" if d else f"{h:02d}:{m:02d}:{s:02d}" for d, h, m, s in zip(days, hrs, mins, secs)]
+
+    amounts = rng.choice(["500", "1000", "2.5", "4", "16", "64"], num_rows)
+    units = rng.choice(["M", "G"], num_rows)
+    suffixes = rng.choice(["c", "n"], num_rows)
+    mem = [a + u + s for a, u, s in zip(amounts, units, suffixes)]
+
+    ncpus = rng.integers(1, 129, num_rows).astype(str)
+    nodes = rng.integers(1, 9, num_rows).astype(str)
+    return pd.DataFrame({"Elapsed": elapsed, "ReqMem": mem, "AllocCPUS": ncpus, "NNodes": nodes})
+
+
+def timed(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def run_benchmark(num_rows, repeat):
+    df = make_columns(num_rows)
+    cases = {
+        "Elapsed": (
+            lambda: np.array([parse_time(t) for t in df["Elapsed"]]),
+            lambda: parse_time_column(df["Elapsed"]),
+        ),
+        "ReqMem": (
+            lambda: np.array([parse_mem(m, c, n) for m, c, n in zip(df["ReqMem"], df["AllocCPUS"], df["NNodes"])]),
+            lambda: parse_mem_column(df["ReqMem"], parse_ncpus_column(df["AllocCPUS"]), parse_ncpus_column(df["NNodes"])),
+        ),
+        "AllocCPUS": (
+            lambda: np.array([float(int(c)) for c in df["AllocCPUS"]]),
+            lambda: parse_ncpus_column(df["AllocCPUS"]),
+        ),
+    }
+
+    print(f"{num_rows} rows, best of {repeat}")
+    print(f"{'column':<12}{'scalar (s)':>12}{'vectorized (s)':>16}{'speedup':>10}")
+    for name, (scalar, vectorized) in cases.items():
+        scalar_time, expected = timed(scalar, repeat)
+        vectorized_time, result = timed(vectorized, repeat)
+        if not np.allclose(expected, result):
+            raise RuntimeError(f"Vectorized {name} parser disagrees with the scalar parser.")
+        print(f"{name:<12}{scalar_time:>12.3f}{vectorized_time:>16.3f}{scalar_time/vectorized_time:>9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    run_benchmark(args.rows, args.repeat)
@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import threading
+
+
+HISTORY_DB = "history.db"
+
+# Stored in PRAGMA user_version once SCHEMA has been applied, so later connections skip it
+SCHEMA_VERSION = 1
+
+USER_COLUMNS = ["uid", "nuid", "projects", "gid", "firstName", "lastName", "email"]
+GROUP_COLUMNS = ["gid", "projects", "firstName", "lastName", "email", "dept", "ngid"]
+JOB_COLUMNS = ["job_id", "user", "account", "partition", "month", "ncpus", "elapsed_hours", "cpu_hours", "mem_gb", "gpu_hours"]
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS usage (
+    gid TEXT NOT NULL,
+    month TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (gid, month, metric)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS usage_month ON usage (month, metric);
+CREATE TABLE IF NOT EXISTS users ({", ".join(f"{column} TEXT" for column in USER_COLUMNS)});
+CREATE INDEX IF NOT EXISTS users_uid ON users (uid);
+CREATE TABLE IF NOT EXISTS groups ({", ".join(f"{column} TEXT" for column in GROUP_COLUMNS)});
+CREATE INDEX IF NOT EXISTS groups_gid ON groups (gid);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    user TEXT,
+    account TEXT,
+    partition TEXT,
+    month TEXT,
+    ncpus INTEGER,
+    elapsed_hours REAL,
+    cpu_hours REAL,
+    mem_gb REAL,
+    gpu_hours REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS jobs_month ON jobs (month, account);
+"""
+
+
+def history_path(pkl_path):
+    return os.path.join(pkl_path, HISTORY_DB)
+
+
+def has_history_store(pkl_path):
+    return os.path.exists(history_path(pkl_path))
+
+
+_local = threading.local()
+
+
+# Returns the store for pkl_path, shared by every caller in the same thread. SQLite connections cannot be
+# shared across threads or forked processes, so each of those opens its own; a thread's stores (and their
+# connections) are released when the thread exits.
+def get_history_store(pkl_path):
+    if not hasattr(_local, "stores"):
+        _local.stores = {}
+
+    key = (os.path.abspath(history_path(pkl_path)), os.getpid())
+    if key not in _local.stores:
+        _local.stores[key] = HistoryStore(pkl_path)
+    return _local.stores[key]
+
+
+# SQLite storage for users, groups and usage history. Usage is kept in long format, one row per
+# (gid, month, metric), so single months can be read and written without touching the rest of the history.
+class HistoryStore:
+    def __init__(self, pkl_path):
+        self.path = history_path(pkl_path)
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                self._conn.executescript(SCHEMA)
+                self._conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        return self._conn
+
+    # Connections cannot be pickled; they are reopened on first use
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        return state
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def get_usage(self, gid, month):
+        rows = self.conn.execute("SELECT metric, value FROM usage WHERE gid = ? AND month = ?", (gid, month)).fetchall()
+        if len(rows) == 0:
+            return None
+        return {metric: float("nan") if value is None else value for metric, value in rows}
+
+    # cells is an iterable of (gid, month, {metric: value}); all rows are upserted in one transaction
+    def put_usage(self, cells):
+        rows = [(gid, month, metric, value) for gid, month, usage in cells for metric, value in usage.items()]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO usage (gid, month, metric, value) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (gid, month, metric) DO UPDATE SET value = excluded.value",
+                rows
+            )
+
+    def load_usage(self):
+        usage = {}
+        for gid, month, metric, value in self.conn.execute("SELECT gid, month, metric, value FROM usage"):
+            usage.setdefault(gid, {}).setdefault(month, {})[metric] = float("nan") if value is None else value
+        return usage
+
+    def save_usage(self, usage):
+        self.put_usage((gid, month, cell) for gid, months in usage.items() for month, cell in months.items())
+
+    # Upserts per-job rows (tuples ordered as JOB_COLUMNS) keyed on job_id in one transaction
+    def put_jobs(self, rows):
+        updates = ", ".join(f"{column} = excluded.{column}" for column in JOB_COLUMNS[1:])
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT INTO jobs ({', '.join(JOB_COLUMNS)}) VALUES ({', '.join('?'*len(JOB_COLUMNS))}) "
+                f"ON CONFLICT (job_id) DO UPDATE SET {updates}",
+                rows
+            )
+
+    def load_table(self, table, columns):
+        import pandas as pd
+        return pd.read_sql_query(f"SELECT {', '.join(columns)} FROM {table} ORDER BY rowid", self.conn)
+
+    # Replaces the contents of a table in a single transaction
+    def save_table(self, table, columns, df):
+        import pandas as pd
+        rows = [tuple(None if pd.isna(v) else str(v) for v in row) for row in df[columns].itertuples(index=False, name=None)]
+        with self.conn:
+            self.conn.execute(f"DELETE FROM {table}")
+            self.conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?'*len(columns))})", rows)
+
+    def load_users(self):
+        return self.load_table("users", USER_COLUMNS)
+
+    def save_users(self, users):
+        self.save_table("users", USER_COLUMNS, users)
+
+    def load_groups(self):
+        return self.load_table("groups", GROUP_COLUMNS)
+
+    def save_groups(self, groups):
+        self.save_table("groups", GROUP_COLUMNS, groups)
@@ -1,46 +1,59 @@
 import os
+import json
+import pwd
+from functools import cached_property
 
-import pandas as pd
-import dill as pkl
+from history_store import get_history_store, has_history_store, USER_COLUMNS, GROUP_COLUMNS
+from profiling import timed
 
-from utils import capture
 
+# -- pandas and dill are imported where they are used, so the small admin scripts start quickly -- #
+# -- Data files are read from history.db when it exists (see migrate_history.py) and from the .pkl files otherwise -- #
 
-def load_users(pkl_path):
+def load_users_pkl(pkl_path):
+    import dill as pkl
     file_path = os.path.join(pkl_path, "users.pkl")
     if os.path.exists(file_path):
         with open(file_path, "rb") as f:
             users = pkl.load(f)
         return users 
     else:
-        users = pd.DataFrame(columns=["uid", "nuid", "projects", "gid", "firstName", "lastName", "email"])
+        import pandas as pd
+        users = pd.DataFrame(columns=USER_COLUMNS)
         return users 
 
 
-def save_users(pkl_path, users):
+def save_users_pkl(pkl_path, users):
+    import dill as pkl
     file_path = os.path.join(pkl_path, "users.pkl")
-    with open(file_path, "wb") as f:
+    with open(file_path + ".tmp", "wb") as f:
         pkl.dump(users, f)
+    os.replace(file_path + ".tmp", file_path)
 
 
-def load_groups(pkl_path):
+def load_groups_pkl(pkl_path):
+    import dill as pkl
     file_path = os.path.join(pkl_path, "groups.pkl")
     if os.path.exists(file_path):
         with open(file_path, "rb") as f:
             groups = pkl.load(f)
         return groups
     else:
-        groups = pd.DataFrame(columns=["gid", "projects", "firstName", "lastName", "email", "dept", "ngid"])
+        import pandas as pd
+        groups = pd.DataFrame(columns=GROUP_COLUMNS)
         return groups
 
 
-def save_groups(pkl_path, groups):
+def save_groups_pkl(pkl_path, groups):
+    import dill as pkl
     file_path = os.path.join(pkl_path, "groups.pkl")
-    with open(file_path, "wb") as f:
+    with open(file_path + ".tmp", "wb") as f:
         pkl.dump(groups, f)
+    os.replace(file_path + ".tmp", file_path)
 
 
-def load_usage(pkl_path):
+def load_usage_pkl(pkl_path):
+    import dill as pkl
     file_path = os.path.join(pkl_path, "usage.pkl")
     if os.path.exists(file_path):
         with open(file_path, "rb") as f:
@@ -51,60 +64,337 @@ def load_usage(pkl_path):
         return usage
 
 
-def save_usage(pkl_path, usage):
+def save_usage_pkl(pkl_path, usage):
+    import dill as pkl
     file_path = os.path.join(pkl_path, "usage.pkl")
-    with open(file_path, "wb") as f:
+    with open(file_path + ".tmp", "wb") as f:
         pkl.dump(usage, f)
+    os.replace(file_path + ".tmp", file_path)
+
+
+@timed("storage")
+def load_users(pkl_path):
+    if has_history_store(pkl_path):
+        return get_history_store(pkl_path).load_users()
+    return load_users_pkl(pkl_path)
+
+
+@timed("storage")
+def save_users(pkl_path, users):
+    if has_history_store(pkl_path):
+        get_history_store(pkl_path).save_users(users)
+    else:
+        save_users_pkl(pkl_path, users)
+
+
+@timed("storage")
+def load_groups(pkl_path):
+    if has_history_store(pkl_path):
+        return get_history_store(pkl_path).load_groups()
+    return load_groups_pkl(pkl_path)
+
+
+@timed("storage")
+def save_groups(pkl_path, groups):
+    if has_history_store(pkl_path):
+        get_history_store(pkl_path).save_groups(groups)
+    else:
+        save_groups_pkl(pkl_path, groups)
+
+
+@timed("storage")
+def load_usage(pkl_path):
+    if has_history_store(pkl_path):
+        return get_history_store(pkl_path).load_usage()
+    return load_usage_pkl(pkl_path)
 
 
-def get_projects_and_owners():
+@timed("storage")
+def save_usage(pkl_path, usage):
+    if has_history_store(pkl_path):
+        get_history_store(pkl_path).save_usage(usage)
+    else:
+        save_usage_pkl(pkl_path, usage)
+
+
+# Append-only JSON lines log of usage fetched since the last flush of the main store.
+# A truncated final line from an interrupted write is ignored on replay.
+class UsageJournal:
+    def __init__(self, pkl_path):
+        self.path = os.path.join(pkl_path, "usage_journal.jsonl")
+        self._file = None
+        self.num_entries = 0
+
+    def replay(self):
+        entries = []
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    entries.append((entry["gid"], entry["month"], entry["usage"]))
+        self.num_entries = len(entries)
+        return entries
+
+    def append(self, gid, month, usage):
+        if self._file is None:
+            self._file = open(self.path, "a")
+        self._file.write(json.dumps({"gid": gid, "month": month, "usage": usage}) + "\n")
+        self._file.flush()
+        self.num_entries += 1
+
+    def clear(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.num_entries = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_file"] = None
+        return state
+
+
+class UsageStore:
+    # Cells left in the journal by an interrupted run are loaded as unsaved data, so they are not fetched again.
+    # When journal is set, new cells are also appended to the journal as they arrive, and the journal is
+    # compacted into the main store every compact_every entries.
+    def __init__(self, pkl_path, journal=False, compact_every=1000):
+        self.pkl_path = pkl_path
+        self.history = get_history_store(pkl_path) if has_history_store(pkl_path) else None
+        self._data = None
+        self._cells = {}
+        self.dirty = set()
+
+        self.journal = UsageJournal(pkl_path)
+        self.journaling = journal
+        self.compact_every = compact_every
+        for gid, month, usage in self.journal.replay():
+            self._cells[(gid, month)] = usage
+            self.dirty.add((gid, month))
+
+    # The full usage history is only loaded on first access and then shared by every generator
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = load_usage(self.pkl_path)
+            for (gid, month), usage in self._cells.items():
+                if (gid, month) in self.dirty:
+                    self._data.setdefault(gid, {})[month] = usage
+        return self._data
+
+    # Plot workers receive a pickled Context; they never read usage, so the cached history is not sent
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        state["_cells"] = {}
+        state["dirty"] = set()
+        return state
+
+    def has(self, gid, month):
+        return self.get(gid, month) is not None
+
+    # Returns the usage of gid in month, or None. With history.db this is a point read.
+    def get(self, gid, month):
+        if self.history is None or self._data is not None:
+            return self.data.get(gid, {}).get(month)
+
+        if (gid, month) not in self._cells:
+            self._cells[(gid, month)] = self.history.get_usage(gid, month)
+        return self._cells[(gid, month)]
+
+    def set(self, gid, month, usage):
+        if self._data is not None or self.history is None:
+            self.data.setdefault(gid, {})[month] = usage
+        self._cells[(gid, month)] = usage
+        self.dirty.add((gid, month))
+
+        if self.journaling:
+            self.journal.append(gid, month, usage)
+            if self.journal.num_entries >= self.compact_every:
+                self.flush()
+
+    # history.db only receives the modified cells; usage.pkl has to be rewritten as a whole.
+    # Once the main store is written the journal is no longer needed.
+    def flush(self):
+        if self.dirty:
+            if self.history is not None:
+                self.history.put_usage((gid, month, self._cells[(gid, month)]) for gid, month in sorted(self.dirty))
+            else:
+                save_usage(self.pkl_path, self.data)
+            self.dirty.clear()
+        self.journal.clear()
+
+
+_owner_names = {}
+
+def get_owner_name(uid):
+    if uid not in _owner_names:
+        try:
+            _owner_names[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            _owner_names[uid] = str(uid)
+    return _owner_names[uid]
+
+
+# Lists the (name, owner) of every non-hidden entry in directory, sorted by name
+def scan_directory(directory):
+    entries = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.startswith("."):
+                continue
+            entries.append((entry.name, get_owner_name(entry.stat(follow_symlinks=False).st_uid)))
+    return sorted(entries)
+
+
+# Scans are cached in cache_dir keyed on each directory's mtime, which changes whenever a project is
+# added, removed or renamed. Changing the owner of an existing project does not invalidate the cache.
+@timed("storage")
+def get_projects_and_owners(cache_dir=None):
     root_directories = ["/projects/", "/nbu/"]
     ignored = {"fmp2", "dasarat", "sobled"}
 
+    cache_path = None if cache_dir is None else os.path.join(cache_dir, "projects_cache.json")
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        # A truncated or corrupt cache falls back to a fresh scan
+        try:
+            with open(cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+
     projects = {}
     project_owners = {}
 
+    updated = False
     for dir in root_directories:
-        command = f"ls -l1 {dir}"
-        output = capture(command).strip().split("\n")[1:]
+        try:
+            mtime = os.stat(dir).st_mtime_ns
+        except FileNotFoundError:
+            continue
+
+        if dir in cache and cache[dir]["mtime"] == mtime:
+            entries = cache[dir]["entries"]
+        else:
+            entries = scan_directory(dir)
+            cache[dir] = {"mtime": mtime, "entries": entries}
+            updated = True
 
-        for line in output:
-            data = line.split()
-            owner = data[2]
+        for project_name, owner in entries:
             if owner in ignored:
                 continue
-            project_name = data[-1]
             projects[project_name] = owner
             if owner not in project_owners:
                 project_owners[owner] = []
 
             project_owners[owner].append(project_name)
 
+    if cache_path is not None and updated:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, cache_path)
+
     return projects, project_owners
 
 
 class Context:
-    def __init__(self, path_to_pkl, verbosity=False, insert_data=False, path_to_quota=None):
+    # Groups, users, projects and usage are loaded on first access, so commands that only need
+    # one of them do not pay for the rest. validate checks that every project owner is a known PI.
+    def __init__(self, path_to_pkl, verbosity=False, insert_data=False, path_to_quota=None, validate=True):
         self.verbose = verbosity
 
         self.path_to_quota = path_to_quota
         self.path_to_pkl = path_to_pkl
 
-        self.groups = load_groups(path_to_pkl)
-        self.gids = list(self.groups["gid"])
-        self.users = load_users(path_to_pkl)
-        self.uids = list(self.users["uid"])
+        self.insert = insert_data
 
-        self.projects, self.project_owners = get_projects_and_owners()
+        # Per-group storage totals keyed on the quota file, see StorageReportGenerator
+        self.storage_usage = {}
 
-        self.insert = insert_data
+        if validate:
+            self.validate_owners()
 
+
+    def validate_owners(self):
         ignored = ["root", "shibh", "parif", "johnchris", "gregas"]
         for owner in self.project_owners:
-            if owner not in self.gids and owner not in ignored:
+            if owner not in self.gid_set and owner not in ignored:
                 raise RuntimeError(f"The PI {owner} not found. Add them with `python add_group.py {owner} DEPARTMENT` and run again.")
 
 
+    @cached_property
+    def groups(self):
+        return load_groups(self.path_to_pkl)
+
+
+    @cached_property
+    def users(self):
+        return load_users(self.path_to_pkl)
+
+
+    @cached_property
+    def usage(self):
+        return UsageStore(self.path_to_pkl, journal=self.insert)
+
+
+    @cached_property
+    def project_index(self):
+        return get_projects_and_owners(cache_dir=self.path_to_pkl)
+
+
+    @property
+    def projects(self):
+        return self.project_index[0]
+
+
+    @property
+    def project_owners(self):
+        return self.project_index[1]
+
+
+    # Hashed lookups used in place of list membership and DataFrame queries on hot paths.
+    # Dropped by save_groups/save_users whenever the underlying tables change.
+    @cached_property
+    def gids(self):
+        return list(self.groups["gid"])
+
+
+    @cached_property
+    def gid_set(self):
+        return set(self.gids)
+
+
+    @cached_property
+    def group_info(self):
+        group_info = {}
+        for gid, first_name, last_name, dept in zip(self.groups["gid"], self.groups["firstName"], self.groups["lastName"], self.groups["dept"]):
+            # Missing names (None or NaN) give "." placeholders instead of failing every lookup
+            first_name = first_name if isinstance(first_name, str) else ""
+            last_name = last_name if isinstance(last_name, str) else ""
+            group_info.setdefault(gid, (f"{first_name[:1]}. {last_name}", dept))
+        return group_info
+
+
+    @cached_property
+    def uids(self):
+        return list(self.users["uid"])
+
+
+    @cached_property
+    def uid_to_gid(self):
+        uid_to_gid = {}
+        for uid, gid in zip(self.users["uid"], self.users["gid"]):
+            uid_to_gid.setdefault(uid, gid)
+        return uid_to_gid
+
+
     def get_groups(self):
         return self.gids
 
@@ -114,47 +404,58 @@ class Context:
             return "Unknown"
         if gid == "misc":
             return "Miscellaneous"
-        if gid in self.gids:
-            query_result = self.groups.query(f"gid == \"{gid}\"")
-            first_name = query_result["firstName"].iloc[0]
-            last_name = query_result["lastName"].iloc[0]
-            return first_name[0] + ". " + last_name
+        if gid in self.group_info:
+            return self.group_info[gid][0]
         else:
             return gid
 
 
     def get_project_owner(self, id):
-        if id in self.uids:
-            query_result = self.users.query(f"uid == \"{id}\"")
-            gid = query_result["gid"].iloc[0]
-            return gid
+        if id in self.uid_to_gid:
+            return self.uid_to_gid[id]
         else:
             return self.projects[id]
 
 
     def load_usage(self):
-        return load_usage(self.path_to_pkl)
+        return self.usage.data
 
 
     def save_usage(self, usage):
         save_usage(self.path_to_pkl, usage)
 
 
+    # Writes all (gid, month) cells modified during this run in a single save
+    def flush_usage(self):
+        if self.verbose and self.usage.dirty:
+            print(f"Saving {len(self.usage.dirty)} new usage entries")
+        self.usage.flush()
+
+
     def save_users(self, users):
         save_users(self.path_to_pkl, users)
+        self.users = users
+        for attr in ["uids", "uid_to_gid"]:
+            self.__dict__.pop(attr, None)
+        self.storage_usage.clear()
 
 
     def save_groups(self, groups):
         save_groups(self.path_to_pkl, groups)
+        self.groups = groups
+        for attr in ["gids", "gid_set", "group_info"]:
+            self.__dict__.pop(attr, None)
+        self.storage_usage.clear()
 
 
     def get_department(self, gid: str) -> str:
-        query_result = self.groups.query(f"gid == \"{gid}\"")
-        return query_result["dept"].iloc[0]
+        if gid not in self.group_info:
+            raise ValueError(f"Group {gid} not found.")
+        return self.group_info[gid][1]
 
 
     def get_label(self, label: str) -> str:
-        if label in self.gids:
+        if label in self.gid_set:
             return self.get_group_name(label)
         if label == "misc":
             return "Miscellaneous"
@@ -7,13 +7,16 @@ from user_report import make_user_report
 import sys
 import os
 import time
+import atexit
+import cProfile
 
 import argparse
 from dateutil import relativedelta
 
-from utils import parse_date, set_verbosity
+from utils import parse_date, set_verbosity, set_command_timeout, print_command_summary
 
 from load_data import Context
+from profiling import span, write_profile, print_profile_summary
 
 
 # -- Running functions which collect all usage data over the last NUM_MONTHS starting from THIS_MONTH ----- #
@@ -34,6 +37,13 @@ parser.add_argument("-o", "--output-files", action="store_false")
 parser.add_argument("-v", "--verbose", action="store_true")
 parser.add_argument("-u", "--user", action="store_false")
 parser.add_argument("-d", "--directory")
+parser.add_argument("--sreport-workers", type=int, default=8)
+parser.add_argument("--sreport-batch-size", type=int, default=64)
+parser.add_argument("--sreport-window-days", type=int, default=0)
+parser.add_argument("--plot-workers", type=int, default=None)
+parser.add_argument("--command-timeout", type=float, default=None)
+parser.add_argument("--profile")
+parser.add_argument("--cprofile")
 args = parser.parse_args()
 
 INSERT = args.insert
@@ -44,8 +54,33 @@ THIS_MONTH = parse_date(args.date)
 FIRST_MONTH = THIS_MONTH - relativedelta.relativedelta(months=NUM_MONTHS)
 VERBOSITY = args.verbose
 DIRECTORY = args.directory
+SREPORT_WORKERS = args.sreport_workers
+SREPORT_BATCH_SIZE = args.sreport_batch_size
+SREPORT_WINDOW_DAYS = args.sreport_window_days
+PLOT_WORKERS = args.plot_workers
 
 set_verbosity(VERBOSITY)
+set_command_timeout(args.command_timeout)
+
+# Timing spans are summarized, and written to --profile if given, when the run ends, including early exits and errors.
+# Nothing is written by default so that the report directory only contains the report.
+PROFILE_PATH = args.profile
+profiler = cProfile.Profile() if args.cprofile is not None else None
+
+def finish_profile():
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+        print(f"cProfile stats written to {args.cprofile}")
+
+    if PROFILE_PATH is not None:
+        write_profile(PROFILE_PATH, date=str(THIS_MONTH), num_months=NUM_MONTHS, argv=sys.argv)
+        print(f"Profile written to {PROFILE_PATH}")
+    print_profile_summary()
+
+atexit.register(finish_profile)
+if profiler is not None:
+    profiler.enable()
 
 
 context = Context(verbosity = VERBOSITY, insert_data = INSERT, path_to_quota = "/m31/reps/wekafs.qta", path_to_pkl = os.getenv("REPORT_DATA_PATH", os.getcwd()))
@@ -68,23 +103,30 @@ months = [THIS_MONTH - relativedelta.relativedelta(months=i+1) for i in range(NU
 monthly_reports = []
 
 t0 = time.time()
+prefetch_sreport_usage(context, months, max_workers=SREPORT_WORKERS, batch_size=SREPORT_BATCH_SIZE, window_days=SREPORT_WINDOW_DAYS)
 for n,month in enumerate(months):
     report_generators = [SREPORTGenerator(context, month), StorageReportGenerator(context), GlobalReportGenerator(context, month)]
     monthly_report = MonthlyReport(report_generators)
     monthly_reports.append(monthly_report)
 
-report = Report(context, months, monthly_reports)
+with span("Report"):
+    report = Report(context, months, monthly_reports)
+
+# Serialize data
+if INSERT:
+    with span("flush_usage"):
+        context.flush_usage()
 
 t1 = time.time()
 print(f"Querying usage data took {(t1 - t0):.2f} seconds.")
+if VERBOSITY:
+    print_command_summary()
 
 #if INSERT:
 #    report.insert('monthlyUsage')
 
 # Process report
 group_keys = ["homeStorage", "scratchStorage", "projectStorage", "cpuUsage", "gpuUsage", "reqMem"]
-group_usage = report.get_group_usage(group_keys)
-total_group_usage = {key: {gid: sum(group_usage[key][gid]) for gid in context.gids} for key in SACCT_USAGE_KEYS}
 sum_usage = report.get_sum_usage(group_keys)
 
 home_storage = report.query_group_usage("homeStorage", idx=-1)
@@ -104,38 +146,49 @@ if not OUTPUT_FILES:
     sys.exit(0)
 
 if INSERT:
-    update_users(context)
+    with span("update_users"):
+        update_users(context)
 
 TOTAL_STORAGE_SPACE = 1.5*(1024)**2 # 1.5 PB
 
 plt.rcParams['font.size'] = 25
 
-plot_storage_by_group(context, home_storage, cutoff=11, title=f"/home/ storage", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY, f="home")
-plot_storage_by_group(context, scratch_storage, cutoff=11, title=f"/scratch/ storage", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
-plot_storage_by_group(context, project_storage, cutoff=11, title=f"/projects/ storage", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
-plot_storage_by_department(context, home_storage, title=f"/home/ storage usage by department", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY, f="home")
-plot_storage_by_department(context, scratch_storage, title=f"/scratch/ storage usage by department", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
-plot_storage_by_department(context, project_storage, title=f"/projects/ storage usage by department", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
-plot_storage_by_group_piechart(context, total_storage, cutoff=7, total_storage=TOTAL_STORAGE_SPACE, title=f"Adromeda total storage", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+plots = PlotScheduler(max_workers=PLOT_WORKERS)
 
-plot_usage_by_department(context, total_group_usage["cpuUsage"], start_date=report.months[0], end_date=report.months[-1], title="CPU Usage by department", xlabel="CPU hours used", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
-plot_usage_by_department(context, total_group_usage["gpuUsage"], start_date=report.months[0], end_date=report.months[-1], title="GPU Usage by department", xlabel="GPU hours used", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
-plot_usage_by_group(context, total_group_usage["cpuUsage"], start_date=report.months[0], end_date=report.months[-1], title=f"CPU time used", xlabel = r"CPU hours used", threshold = 15, output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
-plot_usage_by_group(context, total_group_usage["gpuUsage"], start_date=report.months[0], end_date=report.months[-1], title=f"GPU time used", xlabel = r"GPU hours used", threshold = 15, output_extension=OUTPUT_EXTENSION, directory=DIRECTORY, f="GPU")
-plot_usage_by_group(context, total_group_usage["reqMem"], start_date=report.months[0], end_date=report.months[-1], title=f"MEM requested", xlabel=r"GB$\cdot$hrs used", threshold = 15, output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+plots.submit(plot_storage_by_group, context, home_storage, cutoff=11, title=f"/home/ storage", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY, f="home")
+plots.submit(plot_storage_by_group, context, scratch_storage, cutoff=11, title=f"/scratch/ storage", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+plots.submit(plot_storage_by_group, context, project_storage, cutoff=11, title=f"/projects/ storage", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+plots.submit(plot_storage_by_department, report.get_department_usage("homeStorage", idx=-1), title=f"/home/ storage usage by department", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY, f="home")
+plots.submit(plot_storage_by_department, report.get_department_usage("scratchStorage", idx=-1), title=f"/scratch/ storage usage by department", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+plots.submit(plot_storage_by_department, report.get_department_usage("projectStorage", idx=-1), title=f"/projects/ storage usage by department", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+plots.submit(plot_storage_by_group_piechart, context, total_storage, cutoff=7, total_storage=TOTAL_STORAGE_SPACE, title=f"Adromeda total storage", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
 
-plot_yearly_usage(sum_usage["cpuUsage"], months=report.months, title="CPU Usage - All Users", ylabel = "CPU Hours", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
-plot_yearly_usage(sum_usage["gpuUsage"], months=report.months, title="GPU Usage - All Users", ylabel = "GPU Hours", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY, f="GPU")
-plot_yearly_usage(sum_usage["reqMem"], months=report.months, title="MEM Usage - All Users", ylabel = r"GB$\cdot$hours", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+plots.submit(plot_usage_by_department, report.get_department_usage("cpuUsage"), start_date=report.months[0], end_date=report.months[-1], title="CPU Usage by department", xlabel="CPU hours used", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+plots.submit(plot_usage_by_department, report.get_department_usage("gpuUsage"), start_date=report.months[0], end_date=report.months[-1], title="GPU Usage by department", xlabel="GPU hours used", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+plots.submit(plot_usage_by_group, context, report.top_groups("cpuUsage", 15), start_date=report.months[0], end_date=report.months[-1], title=f"CPU time used", xlabel = r"CPU hours used", threshold = 15, output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+plots.submit(plot_usage_by_group, context, report.top_groups("gpuUsage", 15), start_date=report.months[0], end_date=report.months[-1], title=f"GPU time used", xlabel = r"GPU hours used", threshold = 15, output_extension=OUTPUT_EXTENSION, directory=DIRECTORY, f="GPU")
+plots.submit(plot_usage_by_group, context, report.top_groups("reqMem", 15), start_date=report.months[0], end_date=report.months[-1], title=f"MEM requested", xlabel=r"GB$\cdot$hrs used", threshold = 15, output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+
+plots.submit(plot_yearly_usage, sum_usage["cpuUsage"], months=report.months, title="CPU Usage - All Users", ylabel = "CPU Hours", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+plots.submit(plot_yearly_usage, sum_usage["gpuUsage"], months=report.months, title="GPU Usage - All Users", ylabel = "GPU Hours", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY, f="GPU")
+plots.submit(plot_yearly_usage, sum_usage["reqMem"], months=report.months, title="MEM Usage - All Users", ylabel = r"GB$\cdot$hours", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
 
 colors = ["C3", "C0", "C1", "C2"]
 cpu_utilization = [report.query(key) for key in ["cpuAlloc", "cpuIdle", "cpuDown", "cpuPLNDDown"]]
 cpu_labels = ["CPU allocated", "CPU idle", "CPU down", "CPU planned down"]
-plot_utilization(cpu_utilization, cpu_labels, colors, months=report.months, title="CPU Utilization", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+plots.submit(plot_utilization, cpu_utilization, cpu_labels, colors, months=report.months, title="CPU Utilization", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
 gpu_utilization = [report.query(key) for key in ["gpuAlloc", "gpuIdle", "gpuDown", "gpuPLNDDown"]]
 gpu_labels = ["GPU allocated", "GPU idle", "GPU down", "GPU planned down"]
-plot_utilization(gpu_utilization, gpu_labels, colors, months=report.months, title="GPU Utilization", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
-
-make_report_sheet(context, report, group_keys, directory=DIRECTORY)
-make_user_report(context, date_label(THIS_MONTH), directory=DIRECTORY)
-make_group_report(context, date_label(THIS_MONTH), directory=DIRECTORY)
+plots.submit(plot_utilization, gpu_utilization, gpu_labels, colors, months=report.months, title="GPU Utilization", output_extension=OUTPUT_EXTENSION, directory=DIRECTORY)
+
+with span("plots"):
+    plots.run()
+if VERBOSITY:
+    for record in plots.memory:
+        mb = {key: "n/a" if record[key] is None else f"{record[key]:.1f} MB" for key in ["rss_before_mb", "rss_mb", "peak_rss_mb", "peak_increase_mb"]}
+        print(f"{record['plot']} ({record['title']}): rss {mb['rss_before_mb']} -> {mb['rss_mb']}, peak {mb['peak_rss_mb']} (+{mb['peak_increase_mb']})")
+
+with span("spreadsheets"):
+    make_report_sheet(context, report, group_keys, directory=DIRECTORY)
+    make_user_report(context, date_label(THIS_MONTH), directory=DIRECTORY)
+    make_group_report(context, date_label(THIS_MONTH), directory=DIRECTORY)
@@ -0,0 +1,46 @@
+import os
+import argparse
+
+from history_store import HistoryStore, history_path, has_history_store
+from load_data import load_users_pkl, load_groups_pkl, load_usage_pkl
+
+
+# Imports users.pkl, groups.pkl and usage.pkl into history.db. The database is built under a
+# temporary name and moved into place at the end, so readers never see a partial import.
+def migrate_history(pkl_path, verbose=False):
+    users = load_users_pkl(pkl_path)
+    groups = load_groups_pkl(pkl_path)
+    usage = load_usage_pkl(pkl_path)
+
+    tmp_dir = os.path.join(pkl_path, ".history_migration")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = history_path(tmp_dir)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    store = HistoryStore(tmp_dir)
+    store.save_users(users)
+    store.save_groups(groups)
+    store.save_usage(usage)
+    store.close()
+
+    os.replace(tmp_path, history_path(pkl_path))
+    os.rmdir(tmp_dir)
+
+    if verbose:
+        num_cells = sum(len(months) for months in usage.values())
+        print(f"Imported {len(users)} users, {len(groups)} groups and {num_cells} monthly usage entries into {history_path(pkl_path)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-f", "--force", action="store_true")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    path_to_pkl = os.getenv("REPORT_DATA_PATH", os.getcwd())
+    if has_history_store(path_to_pkl) and not args.force:
+        print(f"{history_path(path_to_pkl)} already exists. Run with -f to overwrite it.")
+        quit()
+
+    migrate_history(path_to_pkl, verbose=args.verbose)
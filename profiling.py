@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import functools
+import threading
+import contextlib
+
+from utils import command_records
+
+
+# -- Lightweight timing spans for finding where the time of a report run goes ------------------------------ #
+# -- Each span records its name, category, start time (epoch) and duration. Spans recorded in plot -------- #
+# -- worker processes are sent back to the main process with the plot results (see PlotScheduler.run). ---- #
+
+_spans = []
+_spans_lock = threading.Lock()
+_t0 = time.time()
+
+
+@contextlib.contextmanager
+def span(name, category="phase", **attrs):
+    start = time.time()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = {"name": name, "category": category, "start": start, "seconds": time.perf_counter() - t0, "pid": os.getpid(), **attrs}
+        with _spans_lock:
+            _spans.append(record)
+
+
+# Decorator recording a span named after the function for every call
+def timed(category):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(fn.__name__, category):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def span_count():
+    with _spans_lock:
+        return len(_spans)
+
+
+def spans(start=0):
+    with _spans_lock:
+        return _spans[start:]
+
+
+def add_spans(records):
+    with _spans_lock:
+        _spans.extend(records)
+
+
+# Total, mean and max seconds per (category, name), slowest first
+def profile_summary(records):
+    summary = {}
+    for record in records:
+        entry = summary.setdefault((record["category"], record["name"]), {"category": record["category"], "name": record["name"], "count": 0, "seconds": 0.0, "max_seconds": 0.0})
+        entry["count"] += 1
+        entry["seconds"] += record["seconds"]
+        entry["max_seconds"] = max(entry["max_seconds"], record["seconds"])
+
+    for entry in summary.values():
+        entry["mean_seconds"] = entry["seconds"]/entry["count"]
+
+    return sorted(summary.values(), key=lambda entry: entry["seconds"], reverse=True)
+
+
+def print_profile_summary(records=None):
+    if records is None:
+        records = spans()
+
+    print(f"{'category':<12}{'name':<40}{'count':>7}{'total (s)':>12}{'mean (s)':>12}{'max (s)':>12}")
+    for entry in profile_summary(records):
+        print(f"{entry['category']:<12}{entry['name'][:39]:<40}{entry['count']:>7}{entry['seconds']:>12.2f}{entry['mean_seconds']:>12.3f}{entry['max_seconds']:>12.3f}")
+
+
+# Writes every span, the per-name summary and the external commands run to path as JSON
+def write_profile(path, **info):
+    records = spans()
+    commands = [{"cmd": record.cmd, "returncode": record.returncode, "seconds": record.elapsed, "timed_out": record.timed_out} for record in command_records()]
+    profile = {
+        **info,
+        "start": _t0,
+        "wall_seconds": time.time() - _t0,
+        "summary": profile_summary(records),
+        "spans": records,
+        "commands": commands,
+    }
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(profile, f, indent=1, default=str)
+    os.replace(tmp_path, path)
@@ -0,0 +1,54 @@
+import datetime
+
+import numpy as np
+
+
+# -- Splits a [start, end) query window into consecutive day- or week-sized sub-windows, so that long ----- #
+# -- sreport and sacct queries can run as several short ones. The sub-windows share their boundaries ------ #
+# -- and cover the window exactly once, so partial results can be merged without gaps or overlaps. ------- #
+
+def to_date(date) -> datetime.date:
+    if isinstance(date, datetime.datetime):
+        return date.date()
+    if isinstance(date, datetime.date):
+        return date
+    return datetime.date.fromisoformat(str(date))
+
+
+# Returns [(start, end), ...] covering [start, end) with windows of at most days days.
+# With days <= 0 the whole window is returned as a single sub-window.
+def split_window(start, end, days):
+    start, end = to_date(start), to_date(end)
+    if days <= 0 or end <= start:
+        return [(start, end)]
+
+    step = datetime.timedelta(days=days)
+    windows = []
+    while start < end:
+        windows.append((start, min(start + step, end)))
+        start += step
+    return windows
+
+
+# sacct returns every job that overlaps a window, so a job spanning several sub-windows appears in each
+# of them. Each job is owned by the sub-window containing its start time; jobs that started before the
+# first sub-window belong to the first one, jobs starting after the last to the last. Jobs without a start
+# time get -1: they are kept from every sub-window they appear in, and rows keyed on job id merge them.
+def job_windows(start_times, windows):
+    start_times = np.asarray(start_times, dtype=str)
+    boundaries = np.array([f"{start}T00:00:00" for start, _ in windows])
+    started = np.char.isdigit(start_times.astype("U4"))
+
+    index = np.searchsorted(boundaries, start_times, side="right") - 1
+    return np.where(started, np.clip(index, 0, len(windows) - 1), -1)
+
+
+# Sums the per-account usages of consecutive sub-windows in window order
+def merge_usage(partials):
+    usage = {}
+    for partial in partials:
+        for account, account_usage in partial.items():
+            merged = usage.setdefault(account, {})
+            for key, value in account_usage.items():
+                merged[key] = merged.get(key, 0.0) + value
+    return usage
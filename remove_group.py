@@ -1,10 +1,9 @@
-import dill as pkl
-import pandas as pd
 import os
 
 import argparse
 
-from add_group import load_groups, save_groups
+from utils import read_manifest
+from load_data import load_groups, save_groups
 
 def remove_group(pkl_path, gid):
     print(f'Deleting {gid}. ')
@@ -30,13 +29,43 @@ def remove_group(pkl_path, gid):
 
         save_groups(pkl_path, groups)
 
+# Removes every gid listed in a manifest with a single confirmation and save
+def remove_groups_from_manifest(pkl_path, manifest):
+    gids = [row[0] for row in read_manifest(manifest, header="gid")]
+
+    groups = load_groups(pkl_path)
+    missing = sorted(set(gids) - set(groups['gid']))
+    if missing:
+        print(f'Users {", ".join(missing)} do not exist. No groups were removed.')
+        return
+
+    print(f'Deleting {", ".join(gids)}. ')
+
+    s = ''
+    while s not in ['y', 'Y', 'n', 'N']: 
+        s = input('Is this correct? (y/n): ')
+        if s == 'y' or s == 'Y':
+            break
+        elif s == 'n' or s == 'N':
+            print('Please try again.')
+            return
+        else:
+            print('Please enter either y or n.')
+
+    groups = groups[~groups.gid.isin(gids)]
+    save_groups(pkl_path, groups)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
-    parser.add_argument("gid")
+    parser.add_argument("gid", nargs="?")
+    parser.add_argument("-m", "--manifest", help="CSV or TSV file whose first column lists the gids to remove")
     args = parser.parse_args()
 
-    gid = args.gid
-
     pkl_path = os.getenv("REPORT_DATA_PATH", os.getcwd())
-    remove_group(pkl_path, gid)
+    if args.manifest is not None:
+        remove_groups_from_manifest(pkl_path, args.manifest)
+    elif args.gid is None:
+        parser.error("provide a gid or --manifest")
+    else:
+        remove_group(pkl_path, args.gid)
@@ -1,5 +1,3 @@
-import dill as pkl
-import pandas as pd
 import os
 
 import argparse
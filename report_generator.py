@@ -1,16 +1,52 @@
 import datetime
+import json
 import re
 import os
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import numpy as np
 import dill as pkl
 
-from utils import capture, parse_time, parse_mem, parse_storage
+from utils import run_command, parse_time, parse_mem, parse_storage
 
 from load_data import Context
+from query_planner import split_window, merge_usage
+from profiling import span, timed
 
 SACCT_USAGE_KEYS = ["cpuUsage", "gpuUsage", "reqMem"]
 
+# Maps TRES names reported by sreport to usage keys and the factor converting TRES-minutes to hours (GB-hours for mem)
+SREPORT_TRES = {
+    "cpu":      ("cpuUsage", 60),
+    "mem":      ("reqMem",   60*1024),
+    "gres/gpu": ("gpuUsage", 60),
+}
+
+
+# Parses `sreport cluster AccountUtilizationByUser --parsable2 --noheader` output into per-account usage.
+# Only account total rows (empty Login column) of the requested accounts are kept. Slurm reports account
+# names in lowercase, so they are matched case-insensitively and returned under the requested names.
+def parse_account_utilization(output, accounts):
+    usage = {account: {key: 0.0 for key in SACCT_USAGE_KEYS} for account in accounts}
+    requested = {}
+    for account in accounts:
+        requested.setdefault(account.lower(), []).append(account)
+    for line in output:
+        fields = line.split("|")
+        if len(fields) < 6:
+            continue
+
+        account, login, tres, used = fields[1].lower(), fields[2], fields[4], fields[5]
+        if login != "" or account not in requested or tres not in SREPORT_TRES:
+            continue
+
+        key, factor = SREPORT_TRES[tres]
+        for name in requested[account]:
+            usage[name][key] = int(used)/factor
+
+    return usage
+
 class Report:
     def __init__(self, context, months, monthly_reports):
         self.context = context
@@ -29,55 +65,114 @@ class Report:
         for report in self.reports:
             self.all_keys = self.all_keys.union(report.keys())
 
+        self.build_usage_arrays()
+
+    # Collects per-group usage into a dense (key, group, month) array and cluster-wide
+    # values (e.g. utilization) into a (key, month) array, so that aggregations are array reductions.
+    def build_usage_arrays(self):
+        self.group_index = {gid: i for i, gid in enumerate(self.all_groups)}
+
+        group_keys = sorted(key for key in self.all_keys if any(isinstance(report.query(key), dict) for report in self.reports))
+        global_keys = sorted(key for key in self.all_keys if key not in group_keys)
+        self.group_key_index = {key: i for i, key in enumerate(group_keys)}
+        self.global_key_index = {key: i for i, key in enumerate(global_keys)}
+
+        self.group_usage = np.zeros((len(group_keys), len(self.all_groups), self.num_months))
+        self.global_usage = np.zeros((len(global_keys), self.num_months))
+        for m, report in enumerate(self.reports):
+            for key, item in report.usage.items():
+                if key in self.group_key_index:
+                    k = self.group_key_index[key]
+                    for gid, val in item.items():
+                        if gid in self.group_index:
+                            self.group_usage[k, self.group_index[gid], m] = val
+                else:
+                    self.global_usage[self.global_key_index[key], m] = item
+
+        self.group_totals = self.group_usage.sum(axis=2)
+        self.month_totals = self.group_usage.sum(axis=1)
+
+        # Department of every group as an index into department_labels; groups without one are "Unknown"
+        departments = [self.context.get_department(gid) for gid in self.all_groups]
+        departments = [dept if isinstance(dept, str) and dept != "" else "Unknown" for dept in departments]
+        self.department_labels = sorted(set(departments))
+        label_index = {dept: i for i, dept in enumerate(self.department_labels)}
+        self.department_index = np.array([label_index[dept] for dept in departments], dtype=int)
+
+    # Returns the (group, month) usage array for key, zero if no report contains it
+    def usage_array(self, key):
+        if key in self.group_key_index:
+            return self.group_usage[self.group_key_index[key]]
+        return np.zeros((len(self.all_groups), self.num_months))
+
     def get_group_usage(self, keys):
-        total_usage_by_group = {key: {gid: [] for gid in self.all_groups} for key in keys}
+        return {key: dict(zip(self.all_groups, self.usage_array(key).tolist())) for key in keys}
 
+    def get_total_group_usage(self, keys):
+        total_usage_by_group = {}
         for key in keys:
-            for gid in self.all_groups:
-                for i in range(self.num_months):
-                    total_usage_by_group[key][gid].append(self.reports[i].query(key, gid))
+            if key in self.group_key_index:
+                totals = self.group_totals[self.group_key_index[key]]
+            else:
+                totals = np.zeros(len(self.all_groups))
+            total_usage_by_group[key] = dict(zip(self.all_groups, totals.tolist()))
 
         return total_usage_by_group
 
     def get_sum_usage(self, keys):
-        total_usage = {key: [0]*self.num_months for key in keys}
-
+        total_usage = {}
         for key in keys:
-            for i in range(self.num_months):
-                for gid in self.all_groups:
-                    total_usage[key][i] += self.reports[i].query(key, gid)
+            if key in self.group_key_index:
+                total_usage[key] = self.month_totals[self.group_key_index[key]].tolist()
+            else:
+                total_usage[key] = [0.0]*self.num_months
 
         return total_usage
 
+    def get_department_usage(self, key, idx=None):
+        usage = self.usage_array(key)
+        usage = usage.sum(axis=1) if idx is None else usage[:, idx]
+
+        totals = np.bincount(self.department_index, weights=usage, minlength=len(self.department_labels))
+        return dict(zip(self.department_labels, totals.tolist()))
+
+    def top_groups(self, key, n, idx=None):
+        usage = self.usage_array(key)
+        usage = usage.sum(axis=1) if idx is None else usage[:, idx]
+
+        order = np.argsort(usage, kind="stable")[::-1][:n]
+        return [(self.all_groups[i], float(usage[i])) for i in order]
+
     def query(self, key, idx=None):
         if idx is None:
             idx = list(range(self.num_months))
 
+        if key in self.global_key_index:
+            return self.global_usage[self.global_key_index[key], idx].tolist()
+
         usage = [self.reports[i].query(key) for i in idx]
 
         return usage
 
 
     def query_group_usage(self, key, idx=None):
-        if idx is None:
-            idx = list(range(self.num_months))
-
+        usage = self.usage_array(key)
         if isinstance(idx, int):
-            usage = {gid: self.reports[idx].query(key, gid) for gid in self.all_groups}
-        else:
-            usage = {gid: [] for gid in self.all_groups}
-            for report in self.reports:
-                for gid in self.all_groups:
-                    usage[gid].append(report.query(key, gid))
+            return dict(zip(self.all_groups, usage[:, idx].tolist()))
 
-        return usage
+        if idx is not None:
+            usage = usage[:, idx]
+
+        return dict(zip(self.all_groups, usage.tolist()))
 
 
 class MonthlyReport:
     def __init__(self, report_generators):
         self.usage = {}
         for report_generator in report_generators:
-            for key, item in report_generator().items():
+            with span(type(report_generator).__name__, "generator", month=getattr(report_generator, "start_date", None)):
+                usage = report_generator()
+            for key, item in usage.items():
                 self.usage[key] = item
 
     def keys(self):
@@ -94,6 +189,29 @@ class MonthlyReport:
             return 0.0
 
 
+# Cluster utilization of months that have ended never changes, so it is kept in utilization_cache.json
+# keyed on (start, end, TRES) and only incomplete months are queried again
+class UtilizationCache:
+    def __init__(self, pkl_path):
+        self.path = os.path.join(pkl_path, "utilization_cache.json")
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def get(self, start_date, end_date, tres):
+        return self.load().get(f"{start_date}|{end_date}|{tres}")
+
+    def put(self, start_date, end_date, tres, usage):
+        cache = self.load()
+        cache[f"{start_date}|{end_date}|{tres}"] = usage
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
 class GlobalReportGenerator:
     def __init__(self, context: Context, start_date: datetime, end_date: datetime = None):
         self.context = context 
@@ -106,8 +224,22 @@ class GlobalReportGenerator:
 
 
     def __call__(self):
-        cmd = f"sreport cluster utilization start={self.start_date} end={self.end_date} -t percent -T ALL --parsable2"
-        output = capture(cmd).strip().split("\n")[5:]
+        cache = UtilizationCache(self.context.path_to_pkl)
+        finalized = self.end_date < datetime.date.today()
+        if finalized:
+            usage = cache.get(self.start_date, self.end_date, "ALL")
+            if usage is not None:
+                return usage
+
+        usage = self.get_utilization_sreport()
+        if finalized:
+            cache.put(self.start_date, self.end_date, "ALL", usage)
+
+        return usage
+
+    def get_utilization_sreport(self):
+        cmd = ["sreport", "cluster", "utilization", f"start={self.start_date}", f"end={self.end_date}", "-t", "percent", "-T", "ALL", "--parsable2"]
+        output = [line for line in run_command(cmd).lines()[5:] if line.strip()]
 
         def parse_percent(s):
             return float(s.replace("%", ""))
@@ -116,9 +248,9 @@ class GlobalReportGenerator:
         gpu_idx = next((i for i, x in enumerate(output) if x.split("|")[1] == "gres/gpu"), -1)
 
         if cpu_idx == -1:
-            raise RuntimeError(f"Could not get CPU usage from output of {cmd}.")
+            raise RuntimeError(f"Could not get CPU usage from output of {' '.join(cmd)}.")
         if gpu_idx == -1:
-            raise RuntimeError(f"Could not get GPU usage from output of {cmd}.")
+            raise RuntimeError(f"Could not get GPU usage from output of {' '.join(cmd)}.")
 
         cpu_utilization = output[cpu_idx].split("|")
         gpu_utilization = output[gpu_idx].split("|")
@@ -148,47 +280,43 @@ class SREPORTGenerator:
         self.start_date = str(self.start_date)
         self.end_date = str(self.end_date)
 
-        self.pkl_data = context.load_usage()
         self.context = context
 
     def __call__(self):
         usage = {key: {} for key in SACCT_USAGE_KEYS}
         for gid in self.context.gids:
-            if gid not in self.pkl_data:
-                self.pkl_data[gid] = {}
-
             if self.month_has_data(gid):
                 if self.context.verbose:
-                    print(f"getting data for {gid} from pkl file")
+                    print(f"getting data for {gid} from history")
                 user_usage = self.get_user_usage_pkl(gid)
             else:
                 if self.context.verbose:
                     print(f"getting for {gid} from sreport")
                 user_usage = self.get_user_usage_sreport(gid)
 
-                # Store new data
-                self.pkl_data[gid][self.start_date] = user_usage
+                # Store new data; written to disk by Context.flush_usage at the end of the run
+                self.context.usage.set(gid, self.start_date, user_usage)
 
             for usage_key in SACCT_USAGE_KEYS:
                 usage[usage_key][gid] = user_usage[usage_key]
 
-        # Serialize data
-        if self.context.insert:
-            self.context.save_usage(self.pkl_data)
-        
         return usage
 
+    # Splits the query window into consecutive generators covering at most days days each
+    def split(self, days: int):
+        return [SREPORTGenerator(self.context, start, end) for start, end in split_window(self.start_date, self.end_date, days)]
+
     def get_user_usage_pkl(self, gid: str):
-        gid_usage = self.pkl_data[gid][self.start_date]
+        gid_usage = self.context.usage.get(gid, self.start_date)
         return gid_usage
 
     def get_project_usage_sreport(self, project: str):
-        cmd = f"sreport cluster AccountUtilizationByUser Accounts={project} -T cpu,mem,gres/gpu start={self.start_date} end={self.end_date} | awk 'NR > 6 {{print $NF}}'"
-        if self.context.verbose:
-            print(cmd)
-        result = capture(cmd).strip().split("\n")
+        cmd = ["sreport", "cluster", "AccountUtilizationByUser", f"Accounts={project}", "-T", "cpu,mem,gres/gpu", f"start={self.start_date}", f"end={self.end_date}"]
+
+        # The last column of the rows after the 6 header lines holds the used TRES-minutes
+        result = [line.split()[-1] for line in run_command(cmd).lines()[6:] if line.strip()]
 
-        if result == ['']:
+        if len(result) == 0:
             cpu = 0.0
             mem = 0.0
             gpu = 0.0
@@ -200,6 +328,13 @@ class SREPORTGenerator:
         usage = {"cpuUsage": cpu, "reqMem": mem, "gpuUsage": gpu}
         return usage
 
+    # Queries several accounts in a single sreport call
+    def get_projects_usage_sreport(self, projects):
+        cmd = ["sreport", "cluster", "AccountUtilizationByUser", f"Accounts={','.join(projects)}", "-T", "cpu,mem,gres/gpu", f"start={self.start_date}", f"end={self.end_date}", "--parsable2", "--noheader"]
+        output = run_command(cmd).lines()
+
+        return parse_account_utilization(output, projects)
+
 
     def get_user_usage_sreport(self, gid: str):
         usage = {key: 0.0 for key in SACCT_USAGE_KEYS}
@@ -214,74 +349,224 @@ class SREPORTGenerator:
 
     # Checks if the database has an entry for a given group and month
     def month_has_data(self, gid: str) -> bool:
-        if gid not in self.pkl_data:
-            if self.context.verbose:
-                print(f"{gid} not found")
-            return False
-
-        if self.start_date not in self.pkl_data[gid]:
+        gid_usage = self.context.usage.get(gid, self.start_date)
+        if gid_usage is None:
             if self.context.verbose:
                 print(f"{self.start_date} for {gid} not found")
             return False
 
-        gid_usage = self.pkl_data[gid][self.start_date]
         if len(gid_usage) == 0:
             print(f"len() = 0 for {gid}")
             return False
 
         for key in SACCT_USAGE_KEYS:
-            if np.isnan(gid_usage[key]):
+            if key not in gid_usage or np.isnan(gid_usage[key]):
                 print("Found invalid val")
                 return False
 
         return True
 
 
+# Fetches every (project, month) missing from the usage store with at most max_workers concurrent
+# sreport calls, so that SREPORTGenerator finds all of its data already cached. When batch_size > 0,
+# the projects of each month are requested batch_size accounts at a time instead of one by one.
+# When window_days > 0, each month is queried as sub-windows of window_days days whose usages are
+# summed once all of them have arrived; sreport only counts usage inside the requested window, so
+# jobs spanning several sub-windows are split between them rather than counted twice.
+@timed("sreport")
+def prefetch_sreport_usage(context: Context, months, max_workers: int = 8, batch_size: int = 64, window_days: int = 0):
+    generators = [SREPORTGenerator(context, month) for month in months]
+
+    missing = []
+    for generator in generators:
+        for gid in context.gids:
+            if not generator.month_has_data(gid):
+                missing.append((generator, gid))
+
+    windows = {generator.start_date: generator.split(window_days) for generator in generators}
+
+    jobs = []
+    for generator in generators:
+        projects = [project for g, gid in missing if g is generator for project in context.project_owners.get(gid, [])]
+        if batch_size > 0:
+            batches = [projects[i:i+batch_size] for i in range(0, len(projects), batch_size)]
+        else:
+            batches = [[project] for project in projects]
+        jobs += [(generator, n, window, batch) for batch in batches for n, window in enumerate(windows[generator.start_date])]
+
+    def run(job):
+        _, _, window, projects = job
+        if batch_size > 0:
+            return window.get_projects_usage_sreport(projects)
+        return {projects[0]: window.get_project_usage_sreport(projects[0])}
+
+    if context.verbose:
+        print(f"Fetching project usages from sreport in {len(jobs)} calls with {max_workers} workers")
+
+    project_usage = {}
+
+    # Merge in project order so totals match the sequential path exactly
+    def store(generator, gid):
+        usage = {key: 0.0 for key in SACCT_USAGE_KEYS}
+        for project in context.project_owners.get(gid, []):
+            for key, val in project_usage[(generator.start_date, project)].items():
+                usage[key] += val
+
+        context.usage.set(gid, generator.start_date, usage)
+
+    # Each group is stored as soon as all of its projects for the month have arrived,
+    # so an interrupted run keeps everything completed up to that point
+    remaining = {}
+    owners = {}
+    for generator, gid in missing:
+        projects = context.project_owners.get(gid, [])
+        remaining[(generator.start_date, gid)] = len(projects)
+        for project in projects:
+            owners[(generator.start_date, project)] = (generator, gid)
+        if len(projects) == 0:
+            store(generator, gid)
+
+    # Usages of each (month, project) by sub-window, merged in window order once complete
+    partials = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(run, job): job for job in jobs}
+        try:
+            for future in as_completed(futures):
+                generator, n, _, _ = futures[future]
+                for project, usage in future.result().items():
+                    key = (generator.start_date, project)
+                    if key not in owners or key in project_usage:
+                        continue
+
+                    window_usage = partials.setdefault(key, [None]*len(windows[generator.start_date]))
+                    if window_usage[n] is not None:
+                        continue
+                    window_usage[n] = {project: usage}
+                    if any(partial is None for partial in window_usage):
+                        continue
+
+                    project_usage[key] = merge_usage(partials.pop(key))[project]
+                    _, gid = owners[key]
+                    remaining[(generator.start_date, gid)] -= 1
+                    if remaining[(generator.start_date, gid)] == 0:
+                        store(generator, gid)
+        except BaseException:
+            # Skip the queued sreport calls instead of running them against a failing slurmdbd
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+
 def default_callback(usage):
     return
 
 
+def to_gigabytes(amount, suffix):
+    amount = float(amount)
+    if suffix == "TB":
+        return amount * 1024
+    elif suffix == "GB":
+        return amount
+    elif suffix == "MB":
+        return amount / 1024
+    elif suffix == "KB":
+        return amount / 1024**2
+    elif suffix == "B":
+        return amount / 1024**3
+    else:
+        raise RuntimeError(f"Error parsing {amount} {suffix} into GB.")
+
+
+# Streams the wekafs quota file and returns a list of (storage type, user or project, size in GB)
+def parse_quota_file(path_to_quota):
+    entries = []
+    with open(path_to_quota) as f:
+        next(f, None)
+        for line in f:
+            line_items = line.split()
+            if len(line_items) < 3:
+                continue
+
+            storage_type, line_user = line_items[0].split(":/")
+            entries.append((storage_type, line_user, to_gigabytes(line_items[1], line_items[2])))
+
+    return entries
+
+
+_quota_cache = {}
+
+
+# Parsed quota entries are memoized on (path, mtime, size), in memory and optionally in cache_dir,
+# so the file is only parsed again when it changes.
+def quota_key(path_to_quota):
+    stat = os.stat(path_to_quota)
+    return (os.path.abspath(path_to_quota), stat.st_mtime_ns, stat.st_size)
+
+
+@timed("quota")
+def load_quota(path_to_quota, cache_dir=None):
+    key = quota_key(path_to_quota)
+    if key in _quota_cache:
+        return _quota_cache[key]
+
+    cache_path = None if cache_dir is None else os.path.join(cache_dir, "quota_cache.pkl")
+    entries = None
+    if cache_path is not None and os.path.exists(cache_path):
+        # An unreadable or truncated cache is treated as a miss and rewritten
+        try:
+            with open(cache_path, "rb") as f:
+                cached = pkl.load(f)
+            if cached.get("key") == key:
+                entries = cached.get("entries")
+        except Exception:
+            entries = None
+
+    if entries is None:
+        entries = parse_quota_file(path_to_quota)
+        if cache_path is not None:
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pkl.dump({"key": key, "entries": entries}, f)
+            os.replace(tmp_path, cache_path)
+
+    _quota_cache.clear()
+    _quota_cache[key] = entries
+    return entries
+
+
 class StorageReportGenerator:
     def __init__(self, context: Context, callback=default_callback):
         self.callback = callback
         self.context = context
 
+    # The per-group totals are memoized on the context under the quota file's (path, mtime, size),
+    # so the generators of every month after the first only copy them
     def __call__(self):
-        def to_gigabytes(amount, suffix):
-            amount = float(amount)
-            if suffix == "TB":
-                return amount * 1024
-            elif suffix == "GB":
-                return amount
-            elif suffix == "MB":
-                return amount / 1024
-            elif suffix == "KB":
-                return amount / 1024**2
-            elif suffix == "B":
-                return amount / 1024**3
-            else:
-                raise RuntimeException(f"Error parsing {amount} {suffix} into GB.")
+        key = quota_key(self.context.path_to_quota)
+        if key not in self.context.storage_usage:
+            self.context.storage_usage.clear()
+            self.context.storage_usage[key] = self.get_storage_usage()
+
+        usage = {storage_key: dict(usage_by_group) for storage_key, usage_by_group in self.context.storage_usage[key].items()}
+
+        # Adding miscellaneous storage
+        self.callback(usage)
+
+        # Return all usage, including snapshot, miscellaneous, etc.
+        return usage
 
+    def get_storage_usage(self):
         usage = {"homeStorage": {}, "scratchStorage": {}, "projectStorage": {}, "nbuStorage": {}}
         storage_type_map = {"home": "homeStorage", "scratch": "scratchStorage", "projects": "projectStorage", "nbu": "nbuStorage"}
 
-        output = capture(f"tail -n +0 {self.context.path_to_quota}").strip().split('\n')[1:]
-        for line in output:
-            line_items = line.split()
-
-            storage_type, line_user = line_items[0].split(":/")
-            if line_user in self.context.uids or line_user in self.context.projects:
+        for storage_type, line_user, size in load_quota(self.context.path_to_quota, self.context.path_to_pkl):
+            if line_user in self.context.uid_to_gid or line_user in self.context.projects:
                 project_owner = self.context.get_project_owner(line_user)
-                if project_owner in self.context.gids:
+                if project_owner in self.context.gid_set:
                     key = storage_type_map[storage_type]
                     if project_owner not in usage[key]:
                         usage[key][project_owner] = 0.0
 
-                    size = to_gigabytes(line_items[1], line_items[2])
                     usage[key][project_owner] += size
 
-        # Adding miscellaneous storage
-        self.callback(usage)
-
-        # Return all usage, including snapshot, miscellaneous, etc.
         return usage
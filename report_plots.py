@@ -2,6 +2,12 @@ import matplotlib.pyplot as plt
 from matplotlib.ticker import FuncFormatter
 import matplotlib as mpl
 
+import functools
+import inspect
+import resource
+
+from profiling import span, span_count, spans, add_spans
+
 import numpy as np
 
 MONTHS = {1: "Jan", 2: "Feb", 3: "Mar", 4: "Apr", 5: "May", 6: "Jun", 7: "Jul", 8: "Aug", 9: "Sep", 10: "Oct", 11: "Nov", 12: "Dec"}
@@ -12,7 +18,95 @@ def date_label(date):
 
 plt.rcParams["font.size"] = 25
 
-def plot_usage_by_group(context, group_usage, start_date, end_date, title=None, xlabel=None, threshold=-1, directory=None, output_extension="png", f=None):
+# Output file for a plot; "/" is stripped from titles such as "/home/ storage"
+def plot_path(directory, title, output_extension):
+    return f"{directory}/{title.replace('/', '')}.{output_extension}"
+
+
+# -- Figure lifecycle -- #
+
+# Figures are only shown when explicitly requested; batch runs just save and close them
+_show_plots = False
+
+def set_show_plots(show: bool):
+    global _show_plots
+    _show_plots = show
+
+
+def save_figure(fig, path):
+    fig.savefig(path, bbox_inches="tight")
+    if _show_plots:
+        plt.show()
+
+
+# Memory (MB) recorded for each plot, to check that memory stays flat across plots: resident memory before the
+# plot and after its figures are closed, and the peak while it ran. The per-plot peak needs Linux, where the
+# high-water mark can be reset through /proc/self/clear_refs; elsewhere it is None.
+plot_memory = []
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*resource.getpagesize()/1024**2
+    except OSError:
+        return None
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    return None
+
+
+def record_plot_memory(name, title, rss_before, peak_was_reset):
+    peak = peak_rss() if peak_was_reset else None
+    record = {
+        "plot": name,
+        "title": title,
+        "rss_before_mb": rss_before,
+        "rss_mb": current_rss(),
+        "peak_rss_mb": peak,
+        "peak_increase_mb": None if peak is None or rss_before is None else peak - rss_before,
+    }
+    plot_memory.append(record)
+    return record
+
+
+# Closes every figure opened by a plot function, even if it raises
+def managed_figure(plot_fn):
+    @functools.wraps(plot_fn)
+    def wrapper(*args, **kwargs):
+        open_figures = set(plt.get_fignums())
+        rss_before = current_rss()
+        peak_was_reset = reset_peak_rss()
+        try:
+            with span(plot_fn.__name__, "plot", title=kwargs.get("title")):
+                return plot_fn(*args, **kwargs)
+        finally:
+            for num in set(plt.get_fignums()) - open_figures:
+                plt.close(num)
+            record_plot_memory(plot_fn.__name__, kwargs.get("title"), rss_before, peak_was_reset)
+
+    return wrapper
+
+
+@managed_figure
+# top_groups is a list of (gid, usage) sorted by decreasing usage, e.g. from Report.top_groups; groups below threshold are left out
+def plot_usage_by_group(context, top_groups, start_date, end_date, title=None, xlabel=None, threshold=-1, directory=None, output_extension="png", f=None):
     if directory is None:
         directory = ""
     else:
@@ -20,23 +114,19 @@ def plot_usage_by_group(context, group_usage, start_date, end_date, title=None,
             directory = directory[:-1]
     fig, ax = plt.subplots(figsize=(20,12))
 
-    users, time = zip(*[(k, v) for k,v in group_usage.items() if v >= threshold])
-    sorted_inds = np.flip(np.argsort(time))
-    users, time = np.array(users)[sorted_inds], np.array(time)[sorted_inds]
-    users = users[:threshold]
-    time = time[:threshold]
+    users, time = zip(*[(k, v) for k,v in top_groups if v >= threshold])
 
     ax.barh([context.get_label(gid) for gid in users], time, color="orange", label="Requested")
         
-    plt.yticks(rotation=0)
+    ax.tick_params(axis="y", labelrotation=0)
     ax.set_xlim(0, max(time)*1.2)
     if f is None:
         ax.xaxis.set_major_formatter(FuncFormatter(lambda x, p: str(int(x/1000)) + "k"))
-    plt.title(f"{date_label(start_date)} - {date_label(end_date)}", y=1.0, pad=30)
+    ax.set_title(f"{date_label(start_date)} - {date_label(end_date)}", y=1.0, pad=30)
     if title is not None:
-        plt.suptitle(title)
+        fig.suptitle(title)
     if xlabel is not None:
-        plt.xlabel(xlabel)
+        ax.set_xlabel(xlabel)
 
     # Hide axis spines
     ax.spines["top"].set_visible(False)
@@ -47,15 +137,18 @@ def plot_usage_by_group(context, group_usage, start_date, end_date, title=None,
 
     # Add gridlines
     for tick in ax.get_xticks():
-        plt.axvline(tick, linewidth=0.25, color="k", zorder=0)
+        ax.axvline(tick, linewidth=0.25, color="k", zorder=0)
 
     # Hide ticks and remove bottom ytick corresponding to 0 hours
     ax.tick_params(axis="both", length=0)
     ax.set_xticks(ax.get_xticks()[1:])
 
-    plt.savefig(f"{directory}/{title}.{output_extension}", bbox_inches="tight")
-    plt.show()
+    path = plot_path(directory, title, output_extension)
+    save_figure(fig, path)
+
+    return path
 
+@managed_figure
 def plot_yearly_usage(
         total_usage, 
         months,
@@ -76,20 +169,20 @@ def plot_yearly_usage(
     start_date = months[0]
     end_date = months[-1]
     
-    _, ax = plt.subplots(figsize=(12, 8))
+    fig, ax = plt.subplots(figsize=(12, 8))
     xticks = list(range(0, num_months))
 
     legend_items = []
     
-    plt.plot(xticks, total_usage, color="orange")
+    ax.plot(xticks, total_usage, color="orange")
     legend_items.append((mpl.patches.Rectangle([0,0],0,0, color="orange"), "Requested"))
-    plt.fill_between(xticks, total_usage, color="orange")
-    _, upper = plt.gca().get_ylim()
-    plt.ylim(0, upper)
+    ax.fill_between(xticks, total_usage, color="orange")
+    _, upper = ax.get_ylim()
+    ax.set_ylim(0, upper)
 
  
-    plt.suptitle(title)
-    plt.title(f"{date_label(start_date)} - {date_label(end_date)}")
+    fig.suptitle(title)
+    ax.set_title(f"{date_label(start_date)} - {date_label(end_date)}")
 
 
     # Format x-axis
@@ -101,7 +194,7 @@ def plot_yearly_usage(
 
     # Format y-axis
     if ylabel is not None:
-        plt.ylabel(ylabel)
+        ax.set_ylabel(ylabel)
 
     if f is None:
         ax.yaxis.set_major_formatter(FuncFormatter(lambda x, p: str(int(x/1000)) + "k"))
@@ -115,14 +208,16 @@ def plot_yearly_usage(
 
     # Add gridlines
     for tick in ax.get_yticks():
-        plt.axhline(tick, linewidth=0.25, color="k", zorder=0)
+        ax.axhline(tick, linewidth=0.25, color="k", zorder=0)
 
     # Hide ticks and remove bottom ytick corresponding to 0 hours
     ax.tick_params(axis="both", length=0)
     ax.set_yticks(ax.get_yticks()[1:])
 
-    plt.savefig(f"{directory}/{title}.{output_extension}", bbox_inches="tight")
-    plt.show()
+    path = plot_path(directory, title, output_extension)
+    save_figure(fig, path)
+
+    return path
 
 ABBREVIATIONS = {
     "Carroll School of Management": "CSOM", 
@@ -130,22 +225,24 @@ ABBREVIATIONS = {
     "Earth and Environmental Sciences": "EES",
 }
 
-def plot_usage_by_department(context, total_usage_by_group, start_date, end_date, title, xlabel, directory=None, output_extension="png", f=None):
+def abbreviate_departments(usage_by_department):
+    abbreviated = {}
+    for department, usage in usage_by_department.items():
+        department = ABBREVIATIONS.get(department, department)
+        abbreviated[department] = abbreviated.get(department, 0.) + usage
+    return abbreviated
+
+
+# usage_by_department maps department names to usage, e.g. from Report.get_department_usage
+@managed_figure
+def plot_usage_by_department(usage_by_department, start_date, end_date, title, xlabel, directory=None, output_extension="png", f=None):
     if directory is None:
         directory = ""
     else:
         if directory[-1] == "/":
             directory = directory[:-1]
-    usage_by_department = {}
+    usage_by_department = abbreviate_departments(usage_by_department)
 
-
-    for gid, time in total_usage_by_group.items():
-        department = context.get_department(gid)
-        if department in ABBREVIATIONS:
-            department = ABBREVIATIONS[department]
-        if department not in usage_by_department:
-            usage_by_department[department] = 0.
-        usage_by_department[department] += time
     fig, ax = plt.subplots(figsize=(16,12))
 
     departments, time = zip(*[(k, v) for k,v in usage_by_department.items()])
@@ -153,14 +250,14 @@ def plot_usage_by_department(context, total_usage_by_group, start_date, end_date
     departments, time = np.array(departments)[sorted_inds], np.array(time)[sorted_inds]
 
     ax.barh(departments, time, color="orange")
-    plt.yticks(rotation=0)
-    plt.xlabel(xlabel)
+    ax.tick_params(axis="y", labelrotation=0)
+    ax.set_xlabel(xlabel)
     if f is None:
         ax.xaxis.set_major_formatter(FuncFormatter(lambda x, p: str(int(x/1000)) + "k"))
 
-    plt.title(f"{date_label(start_date)} - {date_label(end_date)}", y=1.0, pad=30)
+    ax.set_title(f"{date_label(start_date)} - {date_label(end_date)}", y=1.0, pad=30)
     if title is not None:
-        plt.suptitle(title)
+        fig.suptitle(title)
 
     # Hide axis spines
     ax.spines["top"].set_visible(False)
@@ -171,35 +268,26 @@ def plot_usage_by_department(context, total_usage_by_group, start_date, end_date
 
     # Add gridlines
     for tick in ax.get_xticks():
-        plt.axvline(tick, linewidth=0.25, color="k", zorder=0)
+        ax.axvline(tick, linewidth=0.25, color="k", zorder=0)
 
     # Hide ticks and remove bottom ytick corresponding to 0 hours
     ax.tick_params(axis="both", length=0)
 
-    plt.savefig(f"{directory}/{title}.{output_extension}", bbox_inches="tight")
-    plt.show()
+    path = plot_path(directory, title, output_extension)
+    save_figure(fig, path)
+
+    return path
 
-def plot_storage_by_department(context, storage_by_group, title=None, directory=None, output_extension="png", f=None):
+# storage_by_department maps department names to storage used, e.g. from Report.get_department_usage
+@managed_figure
+def plot_storage_by_department(storage_by_department, title=None, directory=None, output_extension="png", f=None):
     if directory is None:
         directory = ""
     else:
         if directory[-1] == "/":
             directory = directory[:-1]
-    storage_by_department = {}
-
-    for gid, storage_usage in storage_by_group.items():
-        try:
-            department = context.get_department(gid)
-        except ValueError:
-            continue
-
-        if department in ABBREVIATIONS:
-            department = ABBREVIATIONS[department]
-        
-        if department not in storage_by_department:
-            storage_by_department[department] = 0.
+    storage_by_department = abbreviate_departments(storage_by_department)
 
-        storage_by_department[department] += storage_usage
     fig, ax = plt.subplots(figsize=(16,12))
 
     departments, storage_usage = zip(*[(k, v) for k,v in storage_by_department.items()])
@@ -207,13 +295,13 @@ def plot_storage_by_department(context, storage_by_group, title=None, directory=
     departments, storage_usage = np.array(departments)[sorted_inds], np.array(storage_usage)[sorted_inds]
 
     ax.barh(departments, storage_usage, color="orange")
-    plt.yticks(rotation=0)
-    plt.xlabel("Storage space used (GB)")
+    ax.tick_params(axis="y", labelrotation=0)
+    ax.set_xlabel("Storage space used (GB)")
     if f is None:
         ax.xaxis.set_major_formatter(FuncFormatter(lambda x, p: str(int(x/1000)) + "k"))
 
     if title is not None:
-        plt.suptitle(title)
+        fig.suptitle(title)
 
     # Hide axis spines
     ax.spines["top"].set_visible(False)
@@ -224,15 +312,18 @@ def plot_storage_by_department(context, storage_by_group, title=None, directory=
 
     # Add gridlines
     for tick in ax.get_xticks():
-        plt.axvline(tick, linewidth=0.25, color="k", zorder=0)
+        ax.axvline(tick, linewidth=0.25, color="k", zorder=0)
 
     # Hide ticks and remove bottom ytick corresponding to 0 hours
     ax.tick_params(axis="both", length=0)
 
-    plt.savefig(f"{directory}/{title.replace('/', '')}.{output_extension}", bbox_inches="tight")
-    plt.show()
+    path = plot_path(directory, title, output_extension)
+    save_figure(fig, path)
 
+    return path
 
+
+@managed_figure
 def plot_storage_by_group(context, storage_by_group, cutoff=None, title=None, directory=None, output_extension="png", f=None):
     if directory is None:
         directory = ""
@@ -256,12 +347,12 @@ def plot_storage_by_group(context, storage_by_group, cutoff=None, title=None, di
         storage_usage = np.append(storage_usage, storage_used - displayed_storage)
 
     ax.barh(groups, storage_usage, color="orange")
-    plt.yticks(rotation=0)
-    plt.xlabel("Storage space used (GB)")
+    ax.tick_params(axis="y", labelrotation=0)
+    ax.set_xlabel("Storage space used (GB)")
     if f is None:
         ax.xaxis.set_major_formatter(FuncFormatter(lambda x, p: str(int(x/1000)) + "k"))
     if title is not None:
-        plt.title(title)
+        ax.set_title(title)
 
     # Hide axis spines
     ax.spines["top"].set_visible(False)
@@ -272,14 +363,17 @@ def plot_storage_by_group(context, storage_by_group, cutoff=None, title=None, di
 
     # Add gridlines
     for tick in ax.get_xticks():
-        plt.axvline(tick, linewidth=0.25, color="k", zorder=0)
+        ax.axvline(tick, linewidth=0.25, color="k", zorder=0)
 
     # Hide ticks and remove bottom ytick corresponding to 0 hours
     ax.tick_params(axis="both", length=0)
 
-    plt.savefig(f"{directory}/{title.replace('/', '')}.{output_extension}", bbox_inches="tight")
-    plt.show()
+    path = plot_path(directory, title, output_extension)
+    save_figure(fig, path)
+
+    return path
 
+@managed_figure
 def plot_storage_by_group_piechart(context, storage_by_group, cutoff=None, total_storage=None, title=None, legend=True, directory=None, output_extension="png"):
     if directory is None:
         directory = ""
@@ -290,11 +384,11 @@ def plot_storage_by_group_piechart(context, storage_by_group, cutoff=None, total
     if legend:
         import matplotlib.gridspec as gridspec
         
-        plt.figure(figsize=(18,10))
+        fig = plt.figure(figsize=(18,10))
         gs = gridspec.GridSpec(1, 2, width_ratios=[2.5,1])
-        ax = [plt.subplot(gs[0]), plt.subplot(gs[1])]
+        ax = [fig.add_subplot(gs[0]), fig.add_subplot(gs[1])]
     else:
-        _, ax = plt.subplots(figsize=(18,10))
+        fig, ax = plt.subplots(figsize=(18,10))
 
     groups, storage_usage = zip(*[(k, v) for k,v in storage_by_group.items()])
     sorted_inds = np.flip(np.argsort(storage_usage))
@@ -342,10 +436,10 @@ def plot_storage_by_group_piechart(context, storage_by_group, cutoff=None, total
             startangle=90,
         )
     
-    plt.yticks(rotation=0)
+    fig.gca().tick_params(axis="y", labelrotation=0)
     ax.xaxis.set_major_formatter(FuncFormatter(lambda x, p: str(int(x/1000)) + "k"))
     if title is not None:
-        plt.suptitle(title)
+        fig.suptitle(title)
 
     # Hide axis spines
     ax.spines["top"].set_visible(False)
@@ -356,15 +450,18 @@ def plot_storage_by_group_piechart(context, storage_by_group, cutoff=None, total
 
     # Add gridlines
     for tick in ax.get_xticks():
-        plt.axvline(tick, linewidth=0.25, color="k", zorder=0)
+        fig.gca().axvline(tick, linewidth=0.25, color="k", zorder=0)
 
     # Hide ticks and remove bottom ytick corresponding to 0 hours
     ax.tick_params(axis="both", length=0)
 
-    plt.subplots_adjust(bottom=0., top=1.0)
-    plt.savefig(f"{directory}/{title.replace('/', '')}.{output_extension}", bbox_inches="tight")
-    plt.show()
+    fig.subplots_adjust(bottom=0., top=1.0)
+    path = plot_path(directory, title, output_extension)
+    save_figure(fig, path)
 
+    return path
+
+@managed_figure
 def plot_utilization(utilization, labels, colors, months, title, output_extension="png", directory=None):
     if directory is None:
         directory = ""
@@ -376,20 +473,20 @@ def plot_utilization(utilization, labels, colors, months, title, output_extensio
     start_date = months[0]
     end_date = months[-1]
     
-    _, ax = plt.subplots(figsize=(12, 8))
+    fig, ax = plt.subplots(figsize=(12, 8))
     xticks = list(range(0, num_months))
 
     kwargs = {"linewidth": 4.0, "marker": "o"}
     for util, label, color in zip(utilization, labels, colors):
-        plt.plot(xticks, util, label=label, color=color, **kwargs)
-    plt.legend(fontsize=20)
+        ax.plot(xticks, util, label=label, color=color, **kwargs)
+    ax.legend(fontsize=20)
     #plt.fill_between(xticks, total_usage, color="orange")
-    _, upper = plt.gca().get_ylim()
-    plt.ylim(0, upper)
+    _, upper = ax.get_ylim()
+    ax.set_ylim(0, upper)
 
  
-    plt.suptitle(title)
-    plt.title(f"{date_label(start_date)} - {date_label(end_date)}")
+    fig.suptitle(title)
+    ax.set_title(f"{date_label(start_date)} - {date_label(end_date)}")
 
 
     # Format x-axis
@@ -399,7 +496,7 @@ def plot_utilization(utilization, labels, colors, months, title, output_extensio
     # Format y-axis
     ax.yaxis.set_major_formatter(FuncFormatter(lambda x, p: str(int(x)) + "%"))
 
-    plt.ylabel("Utilization")
+    ax.set_ylabel("Utilization")
 
     # Hide axis spines
     ax.spines["top"].set_visible(False)
@@ -409,20 +506,82 @@ def plot_utilization(utilization, labels, colors, months, title, output_extensio
 
     # Add gridlines
     for tick in ax.get_yticks():
-        plt.axhline(tick, linewidth=0.25, color="k", zorder=0)
+        ax.axhline(tick, linewidth=0.25, color="k", zorder=0)
 
     # Hide ticks and remove bottom ytick corresponding to 0 hours
     ax.tick_params(axis="both", length=0)
     ax.set_yticks(ax.get_yticks()[1:])
 
-    plt.savefig(f"{directory}/{title}.{output_extension}", bbox_inches="tight")
-    plt.show()
+    path = plot_path(directory, title, output_extension)
+    save_figure(fig, path)
+
+    return path
+
+    
+# -- Renders independent plots in a process pool -- #
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+
+def _init_plot_worker(rc):
+    plt.switch_backend("Agg")
+    plt.rcParams.update(rc)
+
+
+def _render_plot(job):
+    plot_fn, args, kwargs = job
+    first_span = span_count()
+    path = plot_fn(*args, **kwargs)
+    return path, plot_memory[-1], spans(first_span)
+
+
+# Output path a plot_* call will write to, resolved from its arguments the same way the plot functions do
+def planned_plot_path(plot_fn, args, kwargs):
+    arguments = inspect.signature(plot_fn).bind(*args, **kwargs)
+    arguments.apply_defaults()
+    directory = arguments.arguments.get("directory") or ""
+    if directory.endswith("/"):
+        directory = directory[:-1]
+    return plot_path(directory, arguments.arguments["title"], arguments.arguments["output_extension"])
+
+
+# Collects calls to the plot_* functions and renders them with up to max_workers processes.
+# Every plot_* function returns the path it saved to, so run() returns the output paths in submission order.
+# Plots that would write to the same file are rejected by submit(), before anything is rendered.
+# The memory recorded for each plot by its worker is kept in self.memory, and its timing spans are added to the profile.
+class PlotScheduler:
+    def __init__(self, max_workers=None, rc=None):
+        self.max_workers = os.cpu_count() if max_workers is None else max_workers
+        self.rc = {"font.size": plt.rcParams["font.size"]} if rc is None else rc
+        self.jobs = []
+        self.paths = set()
+        self.memory = []
+
+    def submit(self, plot_fn, *args, **kwargs):
+        path = planned_plot_path(plot_fn, args, kwargs)
+        if path in self.paths:
+            raise RuntimeError(f"{plot_fn.__name__} ({kwargs.get('title')}) would overwrite {path}, which another plot already writes.")
+        self.paths.add(path)
+        self.jobs.append((plot_fn, args, kwargs))
+
+    def run(self):
+        jobs, self.jobs = self.jobs, []
+        if self.max_workers <= 1 or len(jobs) <= 1:
+            _init_plot_worker(self.rc)
+            results = [_render_plot(job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=min(self.max_workers, len(jobs)), initializer=_init_plot_worker, initargs=(self.rc,)) as executor:
+                results = list(executor.map(_render_plot, jobs))
+            add_spans([record for _, _, plot_spans in results for record in plot_spans])
+
+        self.memory += [memory for _, memory, _ in results]
+        return [path for path, _, _ in results]
 
     
 # -- Generates excel spreadsheet with all usage information -- #
 
-import openpyxl
-from openpyxl.utils import get_column_letter
+from workbook import make_workbook, styled_cell, append_row, set_column_widths, save_workbook
 
 def monthyear(date):
     month = MONTHS[int(date[5:7])]
@@ -440,6 +599,8 @@ def make_report_sheet(context, report, group_keys, directory=None):
     num_months = len(months)
 
     group_usage = report.get_group_usage(group_keys)
+    total_group_usage = report.get_total_group_usage(group_keys)
+    sum_usage = report.get_sum_usage(group_keys)
 
     home_storage = report.query_group_usage("homeStorage", idx=-1)
     scratch_storage = report.query_group_usage("scratchStorage", idx=-1)
@@ -449,110 +610,80 @@ def make_report_sheet(context, report, group_keys, directory=None):
 
     wb_name = f"{directory}/ClusterUsage{report_month}{report_year}.xlsx"
 
-    wb = openpyxl.Workbook()
-
-    font = openpyxl.styles.Font(name="Times New Roman")
-    fontb = openpyxl.styles.Font(name="Times New Roman", bold=True)
+    wb = make_workbook()
 
+    def make_sheet(sheet, usage_by_group, total_by_group, monthly_totals):
+        last_col = 3 + num_months
+        set_column_widths(sheet, {1: 20, 2: 20, **{3 + n: 15 for n in range(num_months)}, last_col: 20})
 
-    def make_sheet(sheet, usage_by_group):
-        def add_cell(row, col, val, font=font):
-            cell = sheet.cell(row=row, column=col)
-            cell.value = val
-            cell.font = font
-
-        add_cell(4, 1, "Group", fontb)
-        sheet.column_dimensions[get_column_letter(1)].width = 20
-        add_cell(4, 2, "Department", fontb)
-        sheet.column_dimensions[get_column_letter(2)].width = 20
+        for _ in range(3):
+            sheet.append([])
 
+        year_row = ["Group", "Department"]
+        month_row = [None, None]
         visited_years = set()
-
-        for n,month in enumerate(months):
-            sheet.column_dimensions[get_column_letter(3 + n)].width = 15
+        for month in months:
             month, year = monthyear(month)
-            
-            add_cell(5, 3 + n, month, fontb)
+            month_row.append(month)
             if year not in visited_years:
                 visited_years.add(year)
-                add_cell(4, 3 + n, year, fontb)
+                year_row.append(year)
+            else:
+                year_row.append(None)
+        month_row.append("1 Yr Total")
 
-        last_col = 4 + n
-        add_cell(5, last_col, "1 Yr Total", fontb)
-        sheet.column_dimensions[get_column_letter(last_col)].width = 20
-        
-        h = 5
-        for n,gid in enumerate(context.gids):
-            name = context.get_group_name(gid)
-            department = context.get_department(gid)
-            total_group_usage = sum([usage_by_group[gid][m] for m in range(num_months)])
+        append_row(sheet, year_row, bold=True)
+        append_row(sheet, month_row, bold=True)
+
+        for gid in context.gids:
+            total_group_usage = total_by_group[gid]
             if total_group_usage < 1:
                 continue
 
-            h += 1
-            add_cell(h, 1, name)
-            add_cell(h, 2, department)
-            for m,_ in enumerate(months):
-                if usage_by_group[gid][m] > 1:
-                    add_cell(h, 3 + m, round(usage_by_group[gid][m], 1))
-            add_cell(h, last_col, round(total_group_usage, 1), fontb)
-
-        last_row = h + 1
-        add_cell(last_row, 1, "Total", fontb)
+            name = context.get_group_name(gid)
+            department = context.get_department(gid)
+            row = [styled_cell(sheet, name), styled_cell(sheet, department)]
+            for usage in usage_by_group[gid]:
+                row.append(styled_cell(sheet, round(usage, 1)) if usage > 1 else None)
+            row.append(styled_cell(sheet, round(total_group_usage, 1), bold=True))
+            sheet.append(row)
 
-        total_usage = 0
-        for i in range(num_months):
-            monthly_usage = sum([usage_by_group[gid][i] for gid in context.gids])
-            total_usage += monthly_usage
-            add_cell(last_row, 3 + i, round(monthly_usage, 1), fontb)
-        add_cell(last_row, last_col, round(total_usage, 1), fontb)
+        total_usage = sum(monthly_totals)
+        append_row(sheet, ["Total", None] + [round(monthly_usage, 1) for monthly_usage in monthly_totals] + [round(total_usage, 1)], bold=True)
 
     def make_storage_sheet(sheet, storage):
-        def add_cell(row, col, val, font=font):
-            cell = sheet.cell(row=row, column=col)
-            cell.value = val
-            cell.font = font
-
-        add_cell(4, 1, "Group", fontb)
-        add_cell(4, 2, "Department", fontb)
-        for n,label in enumerate(storage, 3):
-            add_cell(4, n, label, fontb)
-        
-        last_col = 3 + len(storage)
-        add_cell(4, last_col, "Total", fontb)
+        set_column_widths(sheet, {i: 30 for i in range(1, 3 + len(storage))})
 
-        for i in range(1, 3 + len(storage)):
-            sheet.column_dimensions[get_column_letter(i)].width = 30
+        for _ in range(3):
+            sheet.append([])
+
+        append_row(sheet, ["Group", "Department", *storage, "Total"], bold=True)
 
-        h = 5
         for gid in context.gids:
             if not any([gid in storage[label] and storage[label][gid] > 1 for label in storage]):
                 continue
 
             name = context.get_group_name(gid)
             department = context.get_department(gid)
-            
-            add_cell(h, 1, name)
-            add_cell(h, 2, department)
-            
-            for n,label in enumerate(storage, 3):
+            row = [styled_cell(sheet, name), styled_cell(sheet, department)]
+            for label in storage:
                 if gid in storage[label] and storage[label][gid] > 1:
-                    add_cell(h, n, round(storage[label][gid]), 1)
-                
-            total_storage = sum([0 if gid not in storage[label] else storage[label][gid] for label in storage])
-            add_cell(h, last_col, round(total_storage, 1), fontb)
+                    row.append(styled_cell(sheet, round(storage[label][gid], 1)))
+                else:
+                    row.append(None)
 
-            h += 1
+            total_storage = sum([0 if gid not in storage[label] else storage[label][gid] for label in storage])
+            row.append(styled_cell(sheet, round(total_storage, 1), bold=True))
+            sheet.append(row)
 
-    sheet = wb.active
-    sheet.title = "CPU Usage"
-    make_sheet(sheet, group_usage["cpuUsage"])
+    sheet = wb.create_sheet("CPU Usage")
+    make_sheet(sheet, group_usage["cpuUsage"], total_group_usage["cpuUsage"], sum_usage["cpuUsage"])
 
     sheet = wb.create_sheet("GPU Usage")
-    make_sheet(sheet, group_usage["gpuUsage"])
+    make_sheet(sheet, group_usage["gpuUsage"], total_group_usage["gpuUsage"], sum_usage["gpuUsage"])
 
     sheet = wb.create_sheet("Requested MEM")
-    make_sheet(sheet, group_usage["reqMem"])
+    make_sheet(sheet, group_usage["reqMem"], total_group_usage["reqMem"], sum_usage["reqMem"])
 
     sheet = wb.create_sheet("Storage")
     total_group_storage = {
@@ -565,4 +696,4 @@ def make_report_sheet(context, report, group_keys, directory=None):
 
     if context.verbose:
         print(f"Saving {wb_name}")
-    wb.save(filename=wb_name)
+    save_workbook(wb, wb_name)
@@ -0,0 +1,155 @@
+import os
+import queue
+import threading
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from dateutil import relativedelta
+
+from utils import parse_date, parse_time_column, parse_mem_column, parse_ncpus_column, stream_command, set_verbosity, set_command_timeout, verbose
+from history_store import get_history_store, has_history_store, history_path, JOB_COLUMNS
+from query_planner import split_window, job_windows
+
+
+# -- Streams job-level sacct records for a date window into the jobs table of history.db ----------------- #
+# -- sacct output is parsed chunk_size rows at a time, so memory does not grow with the number of jobs ---- #
+
+SACCT_FIELDS = ["JobID", "User", "Account", "Partition", "Start", "Elapsed", "AllocCPUS", "NNodes", "ReqMem", "AllocTRES"]
+
+
+def sacct_command(start, end):
+    return [
+        "sacct", "--allusers", "--allocations", "--parsable2", "--noheader",
+        f"--starttime={start}", f"--endtime={end}", f"--format={','.join(SACCT_FIELDS)}",
+    ]
+
+
+# Yields DataFrames of at most chunk_size raw sacct records
+def read_sacct(start, end, chunk_size=100_000):
+    rows = []
+    for line in stream_command(sacct_command(start, end)):
+        fields = line.split("|")
+        if len(fields) != len(SACCT_FIELDS):
+            continue
+
+        rows.append(fields)
+        if len(rows) == chunk_size:
+            yield pd.DataFrame(rows, columns=SACCT_FIELDS)
+            rows = []
+
+    if rows:
+        yield pd.DataFrame(rows, columns=SACCT_FIELDS)
+
+
+# Reduces raw sacct records to one compact row per job. Jobs without a start time are assigned to default_month.
+def compact_jobs(chunk, default_month):
+    elapsed_hours = parse_time_column(chunk["Elapsed"])
+    ncpus = np.nan_to_num(parse_ncpus_column(chunk["AllocCPUS"]))
+    nodes = np.nan_to_num(parse_ncpus_column(chunk["NNodes"]))
+    mem_gb = parse_mem_column(chunk["ReqMem"], ncpus, nodes)
+    gpus = chunk["AllocTRES"].str.extract(r"gres/gpu=(\d+)")[0].astype(float).fillna(0.0).to_numpy()
+
+    started = chunk["Start"].str.match(r"^\d{4}-\d{2}")
+    month = np.where(started, chunk["Start"].str.slice(0, 7) + "-01", str(default_month))
+
+    return pd.DataFrame({
+        "job_id": chunk["JobID"].to_numpy(),
+        "user": chunk["User"].to_numpy(),
+        "account": chunk["Account"].to_numpy(),
+        "partition": chunk["Partition"].to_numpy(),
+        "month": month,
+        "ncpus": ncpus.astype(int),
+        "elapsed_hours": elapsed_hours,
+        "cpu_hours": elapsed_hours*ncpus,
+        "mem_gb": mem_gb,
+        "gpu_hours": elapsed_hours*gpus,
+    }, columns=JOB_COLUMNS)
+
+
+# Jobs are keyed on job id, so ingesting overlapping windows again updates rows instead of duplicating them.
+# With window_days > 0 the window is queried as sub-windows of window_days days by up to max_workers
+# concurrent sacct calls. A job overlapping several sub-windows is only kept from the one owning its start
+# time (see query_planner.job_windows). Chunks are written to the store from the calling thread only, and
+# at most 2*max_workers parsed chunks wait for it, so memory stays bounded however many windows there are.
+def ingest_sacct(store, start, end, chunk_size=100_000, window_days=0, max_workers=4):
+    windows = split_window(start, end, window_days)
+    max_workers = max(1, max_workers)
+    chunks = queue.Queue(maxsize=2*max_workers)
+    stop = threading.Event()
+
+    def read_window(n):
+        try:
+            window_start, window_end = windows[n]
+            for chunk in read_sacct(window_start, window_end, chunk_size):
+                if stop.is_set():
+                    break
+                owner = job_windows(chunk["Start"], windows)
+                owned = chunk[(owner == n) | (owner < 0)]
+                chunks.put((compact_jobs(owned, default_month=start), set(chunk["JobID"][owner < 0])))
+        finally:
+            chunks.put(None)
+
+    # Jobs without a start time can come from several sub-windows; they are only counted once
+    num_jobs = 0
+    unstarted = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(read_window, n) for n in range(len(windows))]
+
+        finished = 0
+        try:
+            while finished < len(windows):
+                item = chunks.get()
+                if item is None:
+                    finished += 1
+                    continue
+
+                jobs, unstarted_ids = item
+                jobs = jobs.astype(object).where(jobs.notna(), None)
+                store.put_jobs(jobs.itertuples(index=False, name=None))
+
+                num_jobs += len(jobs) - len(unstarted_ids & unstarted)
+                unstarted |= unstarted_ids
+                if verbose():
+                    print(f"Stored {num_jobs} jobs")
+        except BaseException:
+            # Let the readers finish their current chunk and exit, so that none stays blocked on the full queue
+            stop.set()
+            for future in futures:
+                future.cancel()
+            while finished < sum(not future.cancelled() for future in futures):
+                if chunks.get() is None:
+                    finished += 1
+            raise
+
+    for future in futures:
+        future.result()
+
+    return num_jobs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("date")
+    parser.add_argument("--num-months", type=int, default=1)
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    parser.add_argument("--window-days", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--timeout", type=float, default=None)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    set_verbosity(args.verbose)
+    set_command_timeout(args.timeout)
+    path_to_pkl = os.getenv("REPORT_DATA_PATH", os.getcwd())
+    if not has_history_store(path_to_pkl):
+        raise RuntimeError(f"{history_path(path_to_pkl)} not found. Create it with `python migrate_history.py` first.")
+
+    store = get_history_store(path_to_pkl)
+    first_month = parse_date(args.date)
+    for i in range(args.num_months):
+        start = first_month + relativedelta.relativedelta(months=i)
+        end = start + relativedelta.relativedelta(months=1)
+        num_jobs = ingest_sacct(store, start, end, chunk_size=args.chunk_size, window_days=args.window_days, max_workers=args.workers)
+        print(f"Ingested {num_jobs} jobs for {start}.")
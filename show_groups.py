@@ -1,7 +1,6 @@
-import dill as pkl
 import os
 
-from add_group import load_groups
+from load_data import load_groups
 
 if __name__ == "__main__":
     path_to_pkl = os.getenv("REPORT_DATA_PATH", os.getcwd())
@@ -1,4 +1,3 @@
-import dill as pkl
 import os
 
 from load_data import load_users 
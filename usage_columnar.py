@@ -0,0 +1,111 @@
+import os
+import argparse
+
+import pandas as pd
+
+from load_data import load_usage, save_usage
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+USAGE_COLUMNS = ["gid", "month", "metric", "value"]
+
+
+# -- Long-format (gid, month, metric, value) usage history, exported to Parquet or Feather for analysis -- #
+
+def require_pyarrow():
+    if pa is None:
+        raise RuntimeError("Reading or writing Parquet/Feather usage history requires pyarrow. Install it with `pip install pyarrow`.")
+
+
+def usage_to_frame(usage) -> pd.DataFrame:
+    rows = [(gid, month, metric, value) for gid, months in usage.items() for month, cell in months.items() for metric, value in cell.items()]
+    df = pd.DataFrame(rows, columns=USAGE_COLUMNS)
+    df["value"] = df["value"].astype(float)
+    return df.sort_values(["month", "gid", "metric"], ignore_index=True)
+
+
+def frame_to_usage(df: pd.DataFrame):
+    usage = {}
+    for gid, month, metric, value in df[USAGE_COLUMNS].itertuples(index=False, name=None):
+        usage.setdefault(gid, {}).setdefault(month, {})[metric] = value
+    return usage
+
+
+def file_format(path):
+    extension = os.path.splitext(path)[1]
+    if extension in (".parquet", ".pq"):
+        return "parquet"
+    if extension in (".feather", ".arrow"):
+        return "feather"
+    raise ValueError(f"Unknown usage history format for {path}; use .parquet or .feather.")
+
+
+# Rows are sorted by month so that Parquet row groups can be skipped by month filters.
+# Feather files are written uncompressed so they can be memory-mapped without a copy.
+def write_usage(usage, path):
+    require_pyarrow()
+    table = pa.Table.from_pandas(usage_to_frame(usage), preserve_index=False)
+    if file_format(path) == "parquet":
+        pq.write_table(table, path, row_group_size=64*1024)
+    else:
+        feather.write_feather(table, path, compression="uncompressed")
+
+
+# Reads only the requested columns and the rows matching the gids, metrics and [start, end] month range
+def read_usage(path, gids=None, metrics=None, start=None, end=None, columns=None) -> pd.DataFrame:
+    require_pyarrow()
+    if columns is None:
+        columns = USAGE_COLUMNS
+
+    conditions = []
+    if gids is not None:
+        conditions.append(pc.field("gid").isin(list(gids)))
+    if metrics is not None:
+        conditions.append(pc.field("metric").isin(list(metrics)))
+    if start is not None:
+        conditions.append(pc.field("month") >= str(start))
+    if end is not None:
+        conditions.append(pc.field("month") <= str(end))
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+
+    if file_format(path) == "parquet":
+        table = pq.read_table(path, columns=list(columns), filters=expression, memory_map=True)
+    else:
+        table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+        if expression is not None:
+            table = table.filter(expression)
+        table = table.select(list(columns))
+
+    return table.to_pandas()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path")
+    parser.add_argument("--import", dest="import_usage", action="store_true")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    path_to_pkl = os.getenv("REPORT_DATA_PATH", os.getcwd())
+    if args.import_usage:
+        usage = frame_to_usage(read_usage(args.path))
+        history = load_usage(path_to_pkl)
+        for gid, months in usage.items():
+            history.setdefault(gid, {}).update(months)
+        save_usage(path_to_pkl, history)
+    else:
+        usage = load_usage(path_to_pkl)
+        write_usage(usage, args.path)
+
+    if args.verbose:
+        print(f"{'Imported' if args.import_usage else 'Exported'} {sum(len(months) for months in usage.values())} monthly usage entries")
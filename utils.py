@@ -1,8 +1,13 @@
 import subprocess
+import threading
+import tempfile
+import time
 import re
+import csv
 import datetime
 
 _verbose = False
+_command_timeout = None
 
 
 def set_verbosity(verbosity: bool):
@@ -15,17 +20,142 @@ def verbose() -> bool:
     return _verbose
 
 
-def capture(cmd):
+# Default timeout in seconds for run_command and stream_command; None waits indefinitely
+def set_command_timeout(timeout: float):
+    global _command_timeout
+    _command_timeout = timeout
+
+
+# -- Direct-exec command runner. Commands are argv lists run without a shell; every command's wall time -- #
+# -- and exit status are recorded so that slow or failing sreport/sacct calls show up in the summary. ---- #
+
+class CommandRecord:
+    def __init__(self, cmd, returncode, elapsed, timed_out=False):
+        self.cmd = " ".join(cmd)
+        self.returncode = returncode
+        self.elapsed = elapsed
+        self.timed_out = timed_out
+
+
+class CommandResult:
+    def __init__(self, record, stdout, stderr):
+        self.record = record
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def lines(self):
+        return self.stdout.splitlines()
+
+
+_command_records = []
+_command_lock = threading.Lock()
+
+
+def record_command(cmd, returncode, elapsed, timed_out=False):
+    record = CommandRecord(cmd, returncode, elapsed, timed_out)
+    with _command_lock:
+        _command_records.append(record)
     if _verbose:
-        print(cmd)
-    result = subprocess.run(
-        cmd,
-        shell=True,
-        executable="/usr/bin/bash",
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT
-    )
-    return result.stdout.decode("utf-8")
+        status = "timed out" if timed_out else f"exit {returncode}"
+        print(f"{record.cmd} ({status}, {elapsed:.2f} seconds)")
+    return record
+
+
+def command_records():
+    with _command_lock:
+        return list(_command_records)
+
+
+def command_failed(record, stderr=""):
+    reason = "timed out" if record.timed_out else f"exited with status {record.returncode}"
+    message = f"{record.cmd} {reason}."
+    if stderr.strip():
+        message += f" {stderr.strip()}"
+    return RuntimeError(message)
+
+
+# Runs argv and returns its output. Raises RuntimeError when the command fails or runs longer than timeout seconds, unless check is False.
+def run_command(argv, timeout=None, check=True) -> CommandResult:
+    if timeout is None:
+        timeout = _command_timeout
+    t0 = time.perf_counter()
+    try:
+        result = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=timeout)
+        returncode, stdout, stderr, timed_out = result.returncode, result.stdout, result.stderr, False
+    except subprocess.TimeoutExpired as e:
+        returncode, stdout, stderr, timed_out = None, e.stdout or "", e.stderr or "", True
+        stdout = stdout.decode("utf-8") if isinstance(stdout, bytes) else stdout
+        stderr = stderr.decode("utf-8") if isinstance(stderr, bytes) else stderr
+
+    record = record_command(argv, returncode, time.perf_counter() - t0, timed_out)
+    if check and (timed_out or returncode != 0):
+        raise command_failed(record, stderr)
+    return CommandResult(record, stdout, stderr)
+
+
+# Yields the stdout of argv line by line (without line endings) while the command runs. The command is
+# killed after timeout seconds. Raises RuntimeError once the output is exhausted if the command failed.
+def stream_command(argv, timeout=None):
+    if timeout is None:
+        timeout = _command_timeout
+    t0 = time.perf_counter()
+    # stderr goes to a file so that a command writing a lot of it cannot block on a full pipe
+    stderr = tempfile.TemporaryFile(mode="w+")
+    process = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=stderr, text=True)
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, process.kill)
+        timer.start()
+
+    completed = False
+    try:
+        for line in process.stdout:
+            yield line.rstrip("\n")
+        completed = True
+    finally:
+        # The caller stopped reading early
+        if not completed:
+            process.kill()
+        process.stdout.close()
+        returncode = process.wait()
+        elapsed = time.perf_counter() - t0
+        if timer is not None:
+            timer.cancel()
+        timed_out = timer is not None and returncode < 0 and elapsed >= timeout
+
+        stderr.seek(0)
+        message = stderr.read()
+        stderr.close()
+        record = record_command(argv, returncode, elapsed, timed_out)
+
+    if timed_out or returncode != 0:
+        raise command_failed(record, message)
+
+
+# Prints the number of commands run, their total wall time, failures and the slowest commands
+def print_command_summary(n=10):
+    records = command_records()
+    if len(records) == 0:
+        return
+
+    failed = [record for record in records if record.timed_out or record.returncode != 0]
+    print(f"Ran {len(records)} commands in {sum(record.elapsed for record in records):.2f} seconds; {len(failed)} failed.")
+    for record in sorted(records, key=lambda record: record.elapsed, reverse=True)[:n]:
+        status = "timed out" if record.timed_out else f"exit {record.returncode}"
+        print(f"{record.elapsed:>10.2f} s  {status:<10} {record.cmd}")
+
+
+# Reads the rows of a CSV or TSV (by extension) manifest, skipping blank lines and a header row starting with header
+def read_manifest(path: str, header: str = None) -> list:
+    delimiter = "\t" if path.endswith(".tsv") else ","
+    with open(path, newline="") as f:
+        rows = [[item.strip() for item in row] for row in csv.reader(f, delimiter=delimiter) if any(item.strip() for item in row)]
+
+    if rows and header is not None and rows[0][0] == header:
+        rows = rows[1:]
+
+    return rows
 
 
 def parse_storage(storage: str) -> float:
@@ -102,3 +232,122 @@ def get_usage_time(elapsed: str, ncpu: str) -> int:
     return time*int(ncpu)
 
 
+
+
+# -- Column-wise versions of the sacct parsers above, for ingesting whole sacct outputs at once ---------- #
+# -- Values are parsed as fixed-width byte arrays, so a column of any length costs a few NumPy operations -- #
+# -- instead of one Python call per value. numpy is imported inside these functions so that importing ---- #
+# -- utils stays cheap. Unparseable values become NaN. ----------------------------------------------------- #
+
+MEM_TO_GIGABYTES = {"K": 1e-6, "M": 1e-3, "G": 1.0, "T": 1e3}
+
+
+# Returns a (rows, width) uint8 matrix of the ASCII values (NUL padded) and the length of each value
+def _byte_matrix(values):
+    import numpy as np
+
+    values = np.asarray(values).reshape(-1)
+    if values.dtype.kind not in "SU":
+        try:
+            values = values.astype("S")
+        except UnicodeEncodeError:
+            values = values.astype(str)
+
+    if values.dtype.kind == "U":
+        # Unicode arrays are UCS4; non-ASCII characters are mapped to an unparseable byte
+        matrix = values.view(np.uint32).reshape(len(values), values.dtype.itemsize // 4)
+        matrix = np.where(matrix < 128, matrix, 1).astype(np.uint8)
+    else:
+        matrix = values.view(np.uint8).reshape(len(values), values.dtype.itemsize)
+
+    if matrix.shape[1] == 0:
+        matrix = np.zeros((len(values), 1), dtype=np.uint8)
+    return matrix, (matrix != 0).sum(axis=1)
+
+
+# Converts the first lengths[i] bytes of each row to a float, e.g. the "2" of "2-01:00:00"
+def _leading_numbers(matrix, lengths, valid):
+    import numpy as np
+
+    numbers = np.where(np.arange(matrix.shape[1]) < lengths[:, None], matrix, 0).astype(np.uint8)
+    numbers[~valid | (lengths <= 0), 0] = ord("0")
+    numbers[~valid, 1:] = 0
+    return np.ascontiguousarray(numbers).view(f"S{matrix.shape[1]}").reshape(-1).astype(float)
+
+
+def _is_digit(characters):
+    return (characters >= ord("0")) & (characters <= ord("9"))
+
+
+# Converts a column of sacct elapsed times ([D-]HH:MM:SS) to hours
+def parse_time_column(elapsed):
+    import numpy as np
+
+    matrix, lengths = _byte_matrix(elapsed)
+    rows = np.arange(len(matrix))
+    valid = lengths >= 8
+
+    def at(offset):
+        return matrix[rows, np.maximum(lengths - offset, 0)].astype(np.int64)
+
+    digits = [at(offset) for offset in (8, 7, 5, 4, 2, 1)]
+    for digit in digits:
+        valid &= _is_digit(digit)
+    valid &= (at(6) == ord(":")) & (at(3) == ord(":"))
+    valid &= (lengths == 8) | (at(9) == ord("-"))
+
+    # Everything before the "-" is the number of days
+    day_lengths = lengths - 9
+    day_bytes = np.where(np.arange(matrix.shape[1]) < day_lengths[:, None], matrix, ord("0"))
+    valid &= _is_digit(day_bytes).all(axis=1)
+    days = _leading_numbers(matrix, day_lengths, valid)
+
+    hrs, mins, secs = [10*(digits[i] - ord("0")) + digits[i + 1] - ord("0") for i in (0, 2, 4)]
+    hours = 24*days + hrs + mins/60 + secs/3600
+    return np.where(valid, hours, np.nan)
+
+
+# Converts a column of sacct ReqMem values to gigabytes, multiplying per-core ("c") and per-node ("n")
+# requests by the number of cores and nodes. Values without a suffix are totals for the job.
+def parse_mem_column(mem, ncores, nodes):
+    import numpy as np
+
+    matrix, lengths = _byte_matrix(mem)
+    rows = np.arange(len(matrix))
+
+    suffix = matrix[rows, np.maximum(lengths - 1, 0)]
+    per_core, per_node = suffix == ord("c"), suffix == ord("n")
+    unit_position = lengths - 1 - (per_core | per_node)
+
+    to_gigabytes = np.full(256, np.nan)
+    for unit, scale in MEM_TO_GIGABYTES.items():
+        to_gigabytes[ord(unit)] = scale
+    scale = to_gigabytes[matrix[rows, np.maximum(unit_position, 0)]]
+
+    # Requests of zero may come without a unit, e.g. "0n"
+    has_unit = ~np.isnan(scale)
+    unit_position = np.where(has_unit, unit_position, unit_position + 1)
+
+    number_bytes = np.where(np.arange(matrix.shape[1]) < unit_position[:, None], matrix, ord("0"))
+    valid = (unit_position > 0) & (_is_digit(number_bytes) | (number_bytes == ord("."))).all(axis=1)
+    valid &= (number_bytes == ord(".")).sum(axis=1) <= 1
+    numbers = _leading_numbers(matrix, unit_position, valid)
+    valid &= has_unit | (numbers == 0)
+    gigabytes = numbers * np.where(has_unit, scale, 0.0)
+
+    factor = np.where(per_core, np.asarray(ncores, dtype=float), np.where(per_node, np.asarray(nodes, dtype=float), 1.0))
+    return np.where(valid, gigabytes*factor, np.nan)
+
+
+# Converts a column of sacct counts such as AllocCPUS or NNodes to floats
+def parse_ncpus_column(ncpus):
+    import numpy as np
+
+    matrix, lengths = _byte_matrix(ncpus)
+    valid = (lengths > 0) & (_is_digit(matrix) | (matrix == 0)).all(axis=1)
+    return np.where(valid, _leading_numbers(matrix, lengths, valid), np.nan)
+
+
+# Converts columns of elapsed time and allocated cpus to CPU hours
+def get_usage_time_column(elapsed, ncpu):
+    return parse_time_column(elapsed) * parse_ncpus_column(ncpu)
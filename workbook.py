@@ -0,0 +1,42 @@
+import os
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, NamedStyle
+from openpyxl.utils import get_column_letter
+
+from profiling import span
+
+
+# -- Helpers for streaming report spreadsheets with openpyxl write-only workbooks -- #
+# Rows are appended in order and never kept in memory; cells share two named styles.
+
+def make_workbook():
+    wb = openpyxl.Workbook(write_only=True)
+    wb.add_named_style(NamedStyle(name="report", font=Font(name="Times New Roman")))
+    wb.add_named_style(NamedStyle(name="report_bold", font=Font(name="Times New Roman", bold=True)))
+    return wb
+
+
+def styled_cell(sheet, value, bold=False):
+    if value is None:
+        return None
+
+    cell = WriteOnlyCell(sheet, value=value)
+    cell.style = "report_bold" if bold else "report"
+    return cell
+
+
+def append_row(sheet, values, bold=False):
+    sheet.append([styled_cell(sheet, value, bold) for value in values])
+
+
+# Column widths must be set before the first row is appended
+def set_column_widths(sheet, widths):
+    for col, width in widths.items():
+        sheet.column_dimensions[get_column_letter(col)].width = width
+
+
+def save_workbook(wb, path):
+    with span(os.path.basename(path), "workbook"):
+        wb.save(filename=path)